@@ -1,18 +1,28 @@
+import atexit
+import copy
+import difflib
+import os
+import pickle
 import psycopg2
+import random
 import re
-import statistics
+import threading
+import time
 import uuid
 
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager, suppress
 from functools import partial
 from psycopg2 import sql
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 from tdda import rexpy
 
+import db
+import sketch
+
 import numpy as np
 from sklearn.pipeline import Pipeline
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.feature_extraction.text import HashingVectorizer
 from sklearn.naive_bayes import MultinomialNB
 from scipy import stats
 
@@ -21,21 +31,135 @@ psycopg2.extensions.register_type(psycopg2.extensions.new_type(psycopg2.extensio
 
 BASE_URI = "http://example.com/%s"
 
-class Annotate:
-    def __init__(self):
-        self.conn = None
-        self.text_clf = None
-        self.categories = None
-        self.numeric_data = None
+# Default budget for sampling a column when suggesting a concept
+SAMPLE_ROWS = 10000
+SAMPLE_TIME = 5.0
+
+# Average number of bytes per row assumed for tables without statistics
+ROW_SIZE_GUESS = 100
+
+pwd = os.path.dirname(os.path.realpath(__file__))
+
+# Trained models are stored here, bump the version when their format changes
+MODEL_DIR = os.environ.get("METAMAPPER_MODEL_DIR", os.path.join(pwd, "models"))
+MODEL_VERSION = 1
+
+# Minimum number of seconds between saving incrementally updated models
+SAVE_INTERVAL = 300
+
+# Number of rows of each annotated column kept in concepts__data for training
+CONCEPT_SAMPLE_SIZE = 1000
+
+NUMERIC_TYPES = ("bigint", "integer", "double precision")
+
+DATE_TYPES = ("date", "timestamp")
+
+# Minimum estimated Jaccard similarity for a concept to be suggested by MinHash
+MIN_JACCARD = 0.5
+
+# Approximate memory used by the cache of text predictions of a snapshot, in bytes
+TEXT_CACHE_SIZE = 100 * 1024 * 1024
+
+# Memory used by a cached value besides its probabilities: the value itself, its array and its entry in the cache
+TEXT_CACHE_ENTRY_SIZE = 300
+
+def normalize_header(name):
+    return name \
+        .replace(" ", "") \
+        .replace("_", "") \
+        .replace("-", "") \
+        .lower()
+
+
+def header_similarity(a, b):
+    """
+    Similarity of two normalized column names between 0 and 1
+    """
+
+    if a == b:
+        return 1.0
+
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+class Rules:
+    """
+    Snapshot of the trained models
+
+    A snapshot is never changed once made, retraining makes a new one, so it
+    can be read from several threads without locking. Only the cache of
+    text predictions fills up, under its own lock.
+    """
+
+    def __init__(self, marker, text_clf=None, categories=(), numeric_stats=None):
+        self.marker = marker
+        self.text_clf = text_clf
+        self.categories = tuple(categories)
+        self.numeric_stats = numeric_stats
 
-        if not self.conn:
-            self.conn = psycopg2.connect("host=localhost")
-            self.conn.autocommit = True
+        self.text_cache = OrderedDict()
+        self.text_cache_size = TEXT_CACHE_SIZE // (TEXT_CACHE_ENTRY_SIZE + 4 * len(self.categories))
+        self.lock = threading.Lock()
+
+
+class Annotate:
+    """
+    Suggests concepts for columns, safe to share between threads
+
+    Every operation checks out a pooled database connection. Suggestions
+    are made with the current `Rules` snapshot, while a background thread
+    retrains the models when the data changes and swaps in the new snapshot.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR):
+        self.model_dir = model_dir
+        self.rules = None
+        self.rules_saved_at = 0
+
+        # Work for the trainer thread, see `schedule_training`
+        self.pending = []
+        self.pending_versions = []
+        self.pending_reload = False
+        self.pending_lock = threading.Lock()
+        self.training_lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        # Connection checked out by each thread, see `connect`
+        self.local = threading.local()
 
         self.setup()
 
+        self.trainer = threading.Thread(target=self.train_forever, daemon=True)
+        self.trainer.start()
+        atexit.register(self.save_rules)
+
+    @contextmanager
+    def connect(self):
+        """
+        Check out a pooled connection in autocommit mode for a single operation
+
+        Nested checkouts of a thread share the connection of the outer one, so
+        a thread never holds one connection while waiting for another.
+        """
+
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        with db.connect(statement_timeout=0) as conn:
+            conn.autocommit = True
+            self.local.conn = conn
+            try:
+                yield conn
+            finally:
+                self.local.conn = None
+
     def setup(self):
-        with self.conn.cursor() as cur:
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("select to_regclass('concepts__headers') is null, to_regclass('concepts__sketches') is null")
+            backfill_headers, backfill_sketches = cur.fetchone()
+
             cur.execute("""
                 create table if not exists concepts (
                     uri text primary key,
@@ -55,35 +179,383 @@ class Annotate:
                     value text
                 );
                 create index if not exists "concepts__data_uri_idx" on concepts__data (uri);
+
+                create table if not exists changed_columns (
+                    table_name text,
+                    column_name text,
+
+                    primary key (table_name, column_name)
+                );
+
+                create table if not exists concepts__headers (
+                    uri text references concepts on update cascade on delete cascade,
+                    column_name text,
+                    normalized text,
+
+                    primary key (uri, column_name)
+                );
+                create index if not exists "concepts__headers_normalized_idx" on concepts__headers (normalized);
+
+                -- Mergeable summaries of every annotated column, see sketch.py
+                create table if not exists concepts__sketches (
+                    uri text references concepts on update cascade on delete cascade,
+                    table_name text,
+                    column_name text,
+                    rows bigint,
+                    count bigint,
+                    sum float8,
+                    sum_sq float8,
+                    quantiles float8[],
+                    registers smallint[],
+                    top jsonb,
+
+                    primary key (table_name, column_name)
+                );
+                create index if not exists "concepts__sketches_uri_idx" on concepts__sketches (uri);
+                alter table concepts__sketches add column if not exists minhash bigint[];
+
+                -- Locality sensitive hashing index over the MinHash signatures of text columns
+                create table if not exists concepts__lsh (
+                    band smallint,
+                    bucket bigint,
+                    table_name text,
+                    column_name text,
+
+                    primary key (band, bucket, table_name, column_name),
+                    foreign key (table_name, column_name) references concepts__sketches on delete cascade
+                );
+            """)
+
+            # Bumped on every change to concepts__data or concepts__sketches, to tell whether stored models are still valid
+            db.setup_version(cur, "concepts", ["concepts__data", "concepts__sketches"])
+
+            # Triggers of older versions, before they were named by db.setup_version
+            cur.execute("""
+                drop trigger if exists "concepts__data_version" on concepts__data;
+                drop trigger if exists "concepts__sketches_version" on concepts__sketches;
+            """)
+
+            # Drop the buckets of empty bands that older versions added to the index
+            execute_values(cur, "delete from concepts__lsh where (band, bucket) in (values %s)", sketch.empty_buckets())
+
+            # Index the column names of data that was annotated before the index existed
+            if backfill_headers:
+                cur.execute("""
+                    insert into concepts__headers
+                    select uri, column_name, lower(regexp_replace(column_name, '[ _-]', '', 'g'))
+                    from concepts__data
+                    where uri is not null
+                    group by uri, column_name
+                """)
+
+        # Summarize the values that were copied before sketches were used, and keep a sample of them
+        if backfill_sketches:
+            self.migrate_concept_data()
+
+        self.index_concept_data()
+
+
+    def migrate_concept_data(self):
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("begin")
+            cur.execute("""
+                select distinct on (a.table_name, a.column_name) a.uri, a.table_name, a.column_name, b.data_type
+                from concepts__data a
+                left join concepts b on a.uri = b.uri
+                where a.uri is not null
             """)
 
-        self.generate_all_rules()
+            for uri, table_name, column_name, data_type in cur.fetchall():
+                numeric = data_type in NUMERIC_TYPES
+                relation = sql.SQL("(select value{} as {} from concepts__data where table_name = {} and column_name = {})").format(
+                    sql.SQL("::float8" if numeric else ""),
+                    sql.Identifier(column_name),
+                    sql.Literal(table_name),
+                    sql.Literal(column_name))
+
+                sketches = sketch.compute_sketches(cur, relation, [ (column_name, numeric) ])
+                self.insert_sketch(cur, uri, table_name, column_name, sketches[column_name], index=data_type not in NUMERIC_TYPES + DATE_TYPES)
+
+            cur.execute("""
+                delete from concepts__data where ctid in (
+                    select ctid
+                    from (
+                        select ctid, row_number() over (partition by table_name, column_name order by value is null, random()) as n
+                        from concepts__data
+                    ) _
+                    where n > %s or value is null
+                )
+            """, [ CONCEPT_SAMPLE_SIZE ])
+            cur.execute("commit")
+
+
+    def index_concept_data(self):
+        """
+        Add MinHash signatures to sketches that were made before they were part of them
+
+        Only the sample in concepts__data is left to compute them from.
+        """
+
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("begin")
+            cur.execute("""
+                select a.table_name, a.column_name, b.data_type
+                from concepts__sketches a
+                left join concepts b on a.uri = b.uri
+                where a.minhash is null
+            """)
+
+            for table_name, column_name, data_type in cur.fetchall():
+                cur.execute("select value from concepts__data where table_name = %s and column_name = %s", [ table_name, column_name ])
+                signature = sketch.minhash_signature(cur, [row[0] for row in cur.fetchall()])
+
+                cur.execute("update concepts__sketches set minhash = %s where table_name = %s and column_name = %s", [ signature.tolist(), table_name, column_name ])
+                if data_type not in NUMERIC_TYPES + DATE_TYPES:
+                    self.insert_lsh(cur, table_name, column_name, signature)
+
+            cur.execute("commit")
+
+
+    def insert_sketch(self, cur, uri, table_name, column_name, column_sketch, index=False):
+        cur.execute("""
+            insert into concepts__sketches (uri, table_name, column_name, rows, count, sum, sum_sq, quantiles, registers, top, minhash) values
+                (%(uri)s, %(table_name)s, %(column_name)s, %(rows)s, %(count)s, %(sum)s, %(sum_sq)s, %(quantiles)s, %(registers)s, %(top)s, %(minhash)s)
+        """, {
+            **column_sketch,
+            "uri": uri,
+            "table_name": table_name,
+            "column_name": column_name,
+            "top": Json(column_sketch["top"])
+        })
+
+        if index:
+            self.insert_lsh(cur, table_name, column_name, column_sketch["minhash"])
+
+
+    def insert_lsh(self, cur, table_name, column_name, signature):
+        cur.executemany("insert into concepts__lsh values (%s, %s, %s, %s) on conflict do nothing", [
+            (band, bucket, table_name, column_name) for band, bucket in sketch.lsh_buckets(signature)
+        ])
+
 
+    def data_marker(self):
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("select version from concepts__version")
+            return cur.fetchone()[0]
 
-    def generate_all_rules(self):
-        self.generate_numeric_rules()
+
+    def model_path(self, name):
+        return os.path.join(self.model_dir, f"{name}-v{MODEL_VERSION}.pkl")
+
+
+    def load_rules(self):
+        """
+        Make sure the models reflect the current contents of concepts__data
+
+        Models are trained lazily: the stored models are used when they were
+        trained on the current data, and are only retrained otherwise. Only
+        the first call waits for that, later changes to the data are picked
+        up in the background while the current models stay in use.
+        """
+
+        if self.rules is None:
+            with self.training_lock:
+                if self.rules is None:
+                    self.rules = self.reload_rules(self.data_marker())
+            return
+
+        if self.data_marker() != self.rules.marker:
+            self.schedule_training(reload=True)
+
+
+    def reload_rules(self, marker):
+        with suppress(OSError, pickle.UnpicklingError, EOFError):
+            with open(self.model_path("rules"), "rb") as fin:
+                rules = pickle.load(fin)
+
+            if rules["marker"] == marker:
+                self.rules_saved_at = time.time()
+                return Rules(marker, rules["text_clf"], rules["categories"], rules["numeric_stats"])
+
+        rules = self.generate_all_rules(marker)
+        self.save_rules(rules)
+
+        return rules
+
+
+    def save_rules(self, rules=None):
+        rules = rules or self.rules
+        if rules is None:
+            return
+
+        os.makedirs(self.model_dir, exist_ok=True)
+
+        # Write to a temporary file first, so other processes never read a partial model
+        path = self.model_path("rules")
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as fout:
+            pickle.dump({
+                "marker": rules.marker,
+                "text_clf": rules.text_clf,
+                "categories": list(rules.categories),
+                "numeric_stats": rules.numeric_stats
+            }, fout)
+        os.replace(tmp_path, path)
+
+        self.rules_saved_at = time.time()
+
+
+    def schedule_training(self, refreshed=(), versions=None, reload=False):
+        """
+        Have the trainer thread add refreshed columns to the models, or reload them
+
+        `refreshed` is a list of (table name, column name, concept uri, data
+        type, replaced) of columns whose values were just copied, `versions`
+        the data marker before and after they were copied.
+        """
+
+        with self.pending_lock:
+            self.pending.extend(refreshed)
+            if versions is not None:
+                self.pending_versions.append(versions)
+            self.pending_reload = self.pending_reload or reload
+
+        self.wakeup.set()
+
+
+    def train_forever(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            with self.pending_lock:
+                refreshed, self.pending = self.pending, []
+                versions, self.pending_versions = self.pending_versions, []
+                reload, self.pending_reload = self.pending_reload, False
+
+            try:
+                with self.training_lock:
+                    self.train(refreshed, versions, reload)
+            except Exception as e:
+                print(f"Could not train models: {e}")
+
+
+    def train(self, refreshed, versions, reload):
+        """
+        Make a new snapshot of the models and swap it in
+
+        Refreshed columns are added to a copy of the current models. A reload
+        is only needed when the data changed in other ways, in which case
+        the models are loaded or retrained from scratch.
+        """
+
+        if refreshed and self.rules is not None:
+            self.rules = self.update_rules(self.rules, refreshed, versions)
+
+            if time.time() - self.rules_saved_at >= SAVE_INTERVAL:
+                self.save_rules()
+
+        if reload or self.rules is None:
+            marker = self.data_marker()
+            if self.rules is None or marker != self.rules.marker:
+                self.rules = self.reload_rules(marker)
+
+
+    def update_rules(self, rules, refreshed, versions):
+        # The models are only current when no other changes were made in between the refreshes,
+        # otherwise they keep an older marker and are reloaded by `load_rules`
+        marker = rules.marker
+        for before, after in sorted(versions):
+            if after <= marker:
+                continue
+            if before != marker:
+                break
+            marker = after
+
+        text_clf, categories, numeric_stats = rules.text_clf, rules.categories, rules.numeric_stats
+        text = [r for r in refreshed if r[3] not in NUMERIC_TYPES + DATE_TYPES]
+
+        if any(r[3] in NUMERIC_TYPES for r in refreshed):
+            numeric_stats = self.generate_numeric_rules()
+        if any(r[3] in DATE_TYPES for r in refreshed):
+            self.generate_date_rules()
+
+        if text and (text_clf is None or any(exists for _, _, _, _, exists in text)): # Replaced values cannot be unlearned
+            text_clf, categories = self.generate_text_rules()
+        elif text:
+            text_clf, categories = copy.deepcopy(text_clf), list(categories)
+            for table_name, column_name, uri, _, _ in text:
+                self.update_text_rules(text_clf, categories, uri, table_name, column_name)
+
+        return Rules(marker, text_clf, categories, numeric_stats)
+
+
+    def generate_all_rules(self, marker):
+        numeric_stats = self.generate_numeric_rules()
         self.generate_date_rules()
-        self.generate_text_rules()
+        text_clf, categories = self.generate_text_rules()
+
+        return Rules(marker, text_clf, categories, numeric_stats)
 
 
     def generate_numeric_rules(self):
-        data_types = ("integer", "double precision")
-        self.numeric_data = defaultdict(list)
+        """
+        Summarize the values of every numeric concept
+
+        Only the statistics for the tests in `test_numeric_rules` are kept:
+        the number of values, their mean and variance, and the mean and
+        variance of the absolute deviations from the median (for the
+        Brown-Forsythe variant of Levene's test). They are merged from the
+        sketches of the columns of each concept (see `sketch.numeric_summary`).
+        """
+
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("""
+                select a.uri, b.count, b.sum, b.sum_sq, b.quantiles
+                from concepts a
+                join concepts__sketches b on a.uri = b.uri
+                where a.narrower is null
+                and a.data_type in %s
+                and b.count > 0
+            """, [ NUMERIC_TYPES ])
+
+            sketches = defaultdict(list)
+            for uri, count, total, total_sq, quantiles in cur.fetchall():
+                sketches[uri].append({"count": count, "sum": total, "sum_sq": total_sq, "quantiles": quantiles})
+
+        res = [(uri, *sketch.numeric_summary(column_sketches)) for uri, column_sketches in sketches.items()]
 
-        with self.conn.cursor() as cur:
-            cur.execute(f"select b.value::float8, a.uri from concepts a join concepts__data b on a.uri = b.uri where a.narrower is null and a.data_type in %s and b.value is not null", [ data_types ])
-            for v, k in cur.fetchall(): self.numeric_data[k].append(v)
+        return {
+            "uri": [row[0] for row in res],
+            **{k: np.array([row[i] for row in res], dtype=float) for i, k in enumerate(("n", "mean", "var", "dev_mean", "dev_var"), 1)}
+        }
 
 
     def generate_date_rules(self):
         pass
 
+    def text_pipeline(self):
+        """
+        Text categorization pipeline that can be updated incrementally
+
+        A hashing vectorizer has no vocabulary to fit, so new values (and new
+        categories, see `update_text_rules`) can be added to the model later on.
+        """
+
+        return Pipeline([
+            ('vect', HashingVectorizer(n_features=2 ** 18, alternate_sign=False)),
+            ('clf', MultinomialNB()),
+        ])
+
+
     def generate_text_rules(self):
         """
         Train a text categorization model
 
         Grabs all the known concepts and their instances and passes it
-        into a very simple sklearn pipeline.
+        into a very simple sklearn pipeline. This rebuilds the model from
+        scratch, `update_text_rules` adds a single column to it instead.
+        Returns the model and its categories.
 
         When the number of categories is still small, we pull some demo
         data to create a dummy category. The model tends to always recommend
@@ -92,11 +564,11 @@ class Annotate:
         available category because it does not know better).
         """
 
-        with self.conn.cursor() as cur:
+        with self.connect() as conn, conn.cursor() as cur:
             cur.execute(f"select b.value, a.uri from concepts a join concepts__data b on a.uri = b.uri where a.narrower is null and a.data_type = 'text' and b.value is not null")
 
             if not cur.rowcount >= 1:
-                return
+                return None, []
 
             train = []
             all_categories = []
@@ -104,65 +576,203 @@ class Annotate:
                 train.append(row[0])
                 all_categories.append(row[1])
 
-            self.categories = list(set(all_categories))
-            target = list(map(lambda x: self.categories.index(x), all_categories))
+            categories = list(set(all_categories))
+            target = list(map(lambda x: categories.index(x), all_categories))
 
         # When the list of categories is still small we add a dummy category
-        if len(self.categories) < 10:
-            from sklearn.datasets import fetch_20newsgroups
-
-            train_dummy = set()
-            news = fetch_20newsgroups(subset='train', shuffle=True).data
-            for message in news:
-                for line in message.split("\n"):
-                    for word in line.split(" "):
-                        train_dummy.add(word)
-
-            train.extend(list(train_dummy))
-            self.categories.append('dummy')
-            target.extend(list((self.categories.index('dummy'),) * len(train_dummy)))
-
-        self.text_clf = Pipeline([
-            ('vect', CountVectorizer()),
-            ('tfidf', TfidfTransformer()),
-            ('clf', MultinomialNB()),
-        ])
+        if len(categories) < 10:
+            train_dummy = self.dummy_vocabulary()
+
+            train.extend(train_dummy)
+            categories.append('dummy')
+            target.extend(list((categories.index('dummy'),) * len(train_dummy)))
+
+        text_clf = self.text_pipeline()
+        text_clf.fit(train, target)
+
+        return text_clf, categories
+
+
+    def dummy_vocabulary(self):
+        """
+        Words used to train the dummy category
+
+        They are taken from the 20 newsgroups dataset, which only has to be
+        downloaded and tokenized once since the result is stored.
+        """
+
+        path = self.model_path("dummy")
 
-        self.text_clf.fit(train, target)
+        with suppress(OSError, pickle.UnpicklingError, EOFError):
+            with open(path, "rb") as fin:
+                return pickle.load(fin)
+
+        from sklearn.datasets import fetch_20newsgroups
+
+        train_dummy = set()
+        news = fetch_20newsgroups(subset='train', shuffle=True).data
+        for message in news:
+            for line in message.split("\n"):
+                for word in line.split(" "):
+                    train_dummy.add(word)
+
+        # Sorted, so the model does not depend on the hash seed
+        train_dummy = sorted(train_dummy)
+
+        os.makedirs(self.model_dir, exist_ok=True)
+        with open(path + ".tmp", "wb") as fout:
+            pickle.dump(train_dummy, fout)
+        os.replace(path + ".tmp", path)
+
+        return train_dummy
+
+
+    def update_text_rules(self, text_clf, categories, uri, table_name, column_name):
+        """
+        Add the values of a single column to a text categorization model
+
+        The model and its list of categories are changed in place, so they
+        should not be part of a snapshot in use. Only the new values are
+        vectorized and counted, using `partial_fit`. An unknown concept is
+        added to the model as a new category with empty counts first. The
+        dummy category, when present, stays until the next full rebuild with
+        `generate_text_rules`.
+        """
+
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("select 1 from concepts where uri = %s and narrower is null and data_type = 'text'", [ uri ])
+            if cur.rowcount != 1:
+                return
+
+            cur.execute("select value from concepts__data where table_name = %s and column_name = %s and value is not null", [ table_name, column_name ])
+            train = [row[0] for row in cur.fetchall()]
+
+        if len(train) == 0:
+            return
+
+        clf = text_clf.named_steps['clf']
+
+        if uri not in categories:
+            categories.append(uri)
+            clf.classes_ = np.append(clf.classes_, categories.index(uri))
+            clf.class_count_ = np.append(clf.class_count_, 0)
+            clf.feature_count_ = np.vstack([clf.feature_count_, np.zeros((1, clf.feature_count_.shape[1]))])
+
+        target = [categories.index(uri)] * len(train)
+        clf.partial_fit(text_clf.named_steps['vect'].transform(train), target)
 
 
     def refresh_concept_data(self, uri, data_type, table_name, column_name):
-        with self.conn.cursor() as cur:
-            cur.execute("select 1 from concepts__data where table_name = %s and column_name = %s limit 1", [ table_name, column_name ])
+        self.refresh_table_data(table_name, [ (column_name, uri, data_type) ])
+
+
+    def refresh_table_data(self, table_name, concepts):
+        """
+        Summarize the values of annotated columns for their concepts
+
+        Takes a list of (column name, concept uri, data type). Every column
+        is summarized with sketches in concepts__sketches, and a bounded
+        sample of its values is copied into concepts__data to train the text
+        model on. The table is read first, outside of any transaction, and
+        the results of all columns are then written in one short
+        transaction, after which the rules are refreshed once in the
+        background.
+        """
+
+        self.load_rules()
 
-            if cur.rowcount == 1:
+        with self.connect() as conn, conn.cursor() as cur:
+            # Columns are marked as changed when (re-)ingested, skip the ones that are up to date
+            cur.execute("""
+                select a.column_name
+                from concepts__sketches a
+                left join changed_columns b on a.table_name = b.table_name and a.column_name = b.column_name
+                where a.table_name = %s
+                and b.column_name is null
+            """, [ table_name ])
+            current = set(row[0] for row in cur.fetchall())
+
+            columns = [(column_name, uri, data_type) for column_name, uri, data_type in concepts if column_name not in current]
+            if not columns:
                 return
 
-            cur.execute(sql.SQL("insert into concepts__data select %s, %s, %s, {} from {}").format(
-                sql.Identifier(column_name),
-                sql.Identifier(table_name)
-            ), [
-                uri,
-                table_name,
-                column_name
-            ])
-
-            # Refresh the appropiate rules when new data is added
-            if data_type in ("integer", "double precision"):
-                self.generate_numeric_rules()
-            elif data_type in ("date", "timestamp"):
-                self.generate_date_rules()
-            else:
-                self.generate_text_rules()
+            # Only the pages of a sample of the rows are read, and only the columns that are refreshed
+            cur.execute(sql.SQL("select v.* from (select {} from {} {} order by random() limit {}) t cross join lateral (values {}) v(uri, table_name, column_name, value) where v.value is not null").format(
+                sql.SQL(", ").join([sql.Identifier(column_name) for column_name, _, _ in columns]),
+                sql.Identifier(table_name),
+                self.tablesample(table_name, CONCEPT_SAMPLE_SIZE),
+                sql.Literal(CONCEPT_SAMPLE_SIZE),
+                sql.SQL(", ").join([sql.SQL("({}, {}, {}, {}::text)").format(
+                    sql.Literal(uri),
+                    sql.Literal(table_name),
+                    sql.Literal(column_name),
+                    sql.Identifier("t", column_name)
+                ) for column_name, uri, _ in columns])
+            ))
+            values = cur.fetchall()
+
+            sketches = sketch.compute_sketches(cur, sql.Identifier(table_name), [(column_name, data_type in NUMERIC_TYPES) for column_name, _, data_type in columns])
+
+        refreshed = []
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("begin")
+
+            try:
+                # Refreshes of the same table from other threads wait for this one
+                cur.execute("select pg_advisory_xact_lock(hashtext(%s))", [ table_name ])
 
+                # Other writes to the data wait until this transaction ends, so the version only changes by our own writes
+                cur.execute("select version from concepts__version for update")
+                before, = cur.fetchone()
 
-    def auto_generate_concept(self, table_name, column_name):
+                for column_name, uri, data_type in columns:
+                    cur.execute("select 1 from concepts__sketches where table_name = %s and column_name = %s", [ table_name, column_name ])
+                    exists = cur.rowcount == 1
+
+                    cur.execute("delete from changed_columns where table_name = %s and column_name = %s", [ table_name, column_name ])
+                    changed = cur.rowcount == 1
+
+                    # Another thread refreshed the column in the meantime
+                    if exists and not changed:
+                        continue
+
+                    if exists:
+                        cur.execute("delete from concepts__data where table_name = %s and column_name = %s", [ table_name, column_name ])
+                        cur.execute("delete from concepts__sketches where table_name = %s and column_name = %s", [ table_name, column_name ])
+
+                    refreshed.append((column_name, uri, data_type, exists))
+
+                written = set(column_name for column_name, _, _, _ in refreshed)
+                execute_values(cur, "insert into concepts__data values %s", [row for row in values if row[2] in written], page_size=10000)
+
+                for column_name, uri, data_type, _ in refreshed:
+                    self.insert_sketch(cur, uri, table_name, column_name, sketches[column_name], index=data_type not in NUMERIC_TYPES + DATE_TYPES)
+
+                    # Keep the index of column names per concept up to date
+                    if uri is not None:
+                        cur.execute("insert into concepts__headers values (%s, %s, %s) on conflict do nothing", [ uri, column_name, normalize_header(column_name) ])
+
+                cur.execute("select version from concepts__version")
+                after, = cur.fetchone()
+
+                cur.execute("commit")
+            except Exception:
+                cur.execute("rollback")
+                raise
+
+        # Refresh the appropiate rules when new data is added
+        if refreshed:
+            self.schedule_training([(table_name, *r) for r in refreshed], (before, after))
+
+
+    def auto_generate_concept(self, table_name, column_name, data_type=None):
         concept_name = uuid.uuid4().hex
         uri = BASE_URI % concept_name
 
-        with self.conn.cursor() as cur:
-            cur.execute("select data_type::text from information_schema.columns where table_name = %s and column_name = %s", [ table_name, column_name ])
-            data_type, = cur.fetchone()
+        with self.connect() as conn, conn.cursor() as cur:
+            if data_type is None:
+                cur.execute("select data_type::text from information_schema.columns where table_name = %s and column_name = %s", [ table_name, column_name ])
+                data_type, = cur.fetchone()
 
             cur.execute("insert into concepts (uri, name, data_type) values (%s, %s, %s)", [ uri, concept_name, data_type ])
 
@@ -173,11 +783,11 @@ class Annotate:
         uri = BASE_URI % concept_name
 
         if not narrower:
-            with self.conn.cursor() as cur:
-                cur.execute("select uri from concepts__data where table_name = %s and column_name = %s limit 1", [ table_name, column_name ])
+            with self.connect() as conn, conn.cursor() as cur:
+                cur.execute("select uri from concepts__sketches where table_name = %s and column_name = %s", [ table_name, column_name ])
                 narrower = cur.fetchone()[0]
 
-        with self.conn.cursor() as cur:
+        with self.connect() as conn, conn.cursor() as cur:
             cur.execute("select data_type::text from information_schema.columns where table_name = %s and column_name = %s", [ table_name, column_name ])
             data_type, = cur.fetchone()
 
@@ -185,60 +795,314 @@ class Annotate:
 
 
     def test_numeric_rules(self, data, a=0.05):
-        candidates = {}
-        for k, v in self.numeric_data.items():
-            equal_var = stats.levene(v, data).pvalue > a
-            t = stats.ttest_ind(v, data, equal_var=equal_var).pvalue
+        """
+        Compare a column against all numeric concepts at once
+
+        Runs Levene's test (centered on the median) to decide between a
+        Student or Welch t-test for each concept, equivalent to scipy's
+        `levene` and `ttest_ind`, but vectorized over the summaries made by
+        `generate_numeric_rules`.
+        """
 
-            if t > a:
-                candidates[k] = t
+        s = self.rules.numeric_stats if self.rules else None
+        if not s or len(s["uri"]) == 0 or len(data) < 2:
+            return []
 
-        # Sort the candidates, even though it does not mean much
-        candidates = [k for k, v in sorted(candidates.items(), key=lambda x: x[1], reverse=True)]
+        n1, m1, v1, dm1, dv1 = s["n"], s["mean"], s["var"], s["dev_mean"], s["dev_var"]
+
+        data = np.asarray(data, dtype=float)
+        deviations = np.abs(data - np.median(data))
+        n2, m2, v2, dm2, dv2 = len(data), data.mean(), data.var(ddof=1), deviations.mean(), deviations.var(ddof=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Levene's test is an ANOVA over the absolute deviations, with two groups
+            dm = (n1 * dm1 + n2 * dm2) / (n1 + n2)
+            w = (n1 + n2 - 2) * (n1 * (dm1 - dm) ** 2 + n2 * (dm2 - dm) ** 2) / ((n1 - 1) * dv1 + (n2 - 1) * dv2)
+            equal_var = stats.f.sf(w, 1, n1 + n2 - 2) > a
 
-        return candidates
+            pooled = ((n1 - 1) * v1 + (n2 - 1) * v2) / (n1 + n2 - 2)
+            se = np.where(equal_var, np.sqrt(pooled * (1 / n1 + 1 / n2)), np.sqrt(v1 / n1 + v2 / n2))
+            df = np.where(equal_var, n1 + n2 - 2, (v1 / n1 + v2 / n2) ** 2 / ((v1 / n1) ** 2 / (n1 - 1) + (v2 / n2) ** 2 / (n2 - 1)))
 
-    def test_date_rules(self):
+            t = stats.t.sf(np.abs((m1 - m2) / se), df) * 2
+
+        # Sort the candidates, even though it does not mean much
+        return [s["uri"][i] for i in np.argsort(-t, kind="stable") if t[i] > a]
+
+    def test_date_rules(self, data):
         return []
 
 
+    def test_rules(self, data_type, data, text_scorer="bayes"):
+        """
+        Get a list of potential concepts based on the data
+
+        Text is scored by the text model ("bayes"), by the similarity of its
+        distinct values to those of annotated columns ("minhash"), or by the
+        latter with the text model as a fallback when no similar columns are
+        found ("prefilter").
+        """
+
+        if data_type in NUMERIC_TYPES:
+            return self.test_numeric_rules(data)
+        elif data_type in ("date", "timestamp"):
+            return self.test_date_rules(data)
+        else:
+            if text_scorer in ("minhash", "prefilter"):
+                candidates = self.test_similar_columns(data_type, data)
+                if candidates or text_scorer == "minhash":
+                    return candidates
+
+            return self.test_text_rules(data)
+
+
+    def predict_text(self, rules, values):
+        """
+        Class probabilities of distinct values, cached per value
+
+        Every snapshot of the models has its own cache, which holds as many
+        values as fit in about TEXT_CACHE_SIZE bytes. The probabilities are
+        stored as float32, copied out of the batch they were predicted in.
+        """
+
+        with rules.lock:
+            results = {value: rules.text_cache[value] for value in values if value in rules.text_cache}
+
+        missing = [value for value in values if value not in results]
+        if missing:
+            results.update(zip(missing, (row.copy() for row in rules.text_clf.predict_proba(missing).astype(np.float32))))
+
+        with rules.lock:
+            for value in values:
+                rules.text_cache[value] = results[value]
+                rules.text_cache.move_to_end(value)
+            while len(rules.text_cache) > rules.text_cache_size:
+                rules.text_cache.popitem(last=False)
+
+        return np.array([results[value] for value in values])
+
+
     def test_text_rules(self, data, min_score=0.5):
-        if not self.text_clf:
+        rules = self.rules
+        if not rules or not rules.text_clf:
             return []
 
         if len(data) == 0:
             return []
 
-        best_candidates = []
-        candidates = defaultdict(int)
+        # Predict each distinct value once, and weigh it by how often it occurs
+        counts = Counter(data)
+        weights = np.fromiter(counts.values(), dtype=float, count=len(counts))
+        results = self.predict_text(rules, list(counts))
 
-        results = self.text_clf.predict_proba(data)
-
-        # Only pick categories that got a good score
-        for result in results:
-            for i, candidate in enumerate(result):
-                if candidate >= min_score:
-                    candidates[self.categories[i]] += 1
+        # Only count categories that got a good score
+        scores = weights @ (results >= min_score) / len(data)
 
         # Filter candidates for consistency
-        for k, v in candidates.items():
-            if v / len(data) >= min_score and k != 'dummy':
-                best_candidates.append(k)
+        return [rules.categories[i] for i in np.argsort(-scores, kind="stable") if scores[i] >= min_score and rules.categories[i] != 'dummy']
+
+
+    def test_similar_columns(self, data_type, data, min_similarity=MIN_JACCARD, limit=10):
+        """
+        Find concepts of columns with similar distinct values
+
+        Only columns that share a bucket of the MinHash index are compared,
+        by the estimated Jaccard similarity of their distinct values.
+        """
+
+        if len(data) == 0:
+            return []
+
+        with self.connect() as conn, conn.cursor() as cur:
+            signature = sketch.minhash_signature(cur, set(data))
+            buckets = sketch.lsh_buckets(signature)
+            if not buckets:
+                return []
+
+            cur.execute(sql.SQL("""
+                select b.uri, b.minhash
+                from (
+                    select distinct table_name, column_name
+                    from concepts__lsh
+                    where (band, bucket) in ({})
+                ) a
+                join concepts__sketches b on a.table_name = b.table_name and a.column_name = b.column_name
+                join concepts c on b.uri = c.uri
+                where c.narrower is null
+                and c.data_type = %s
+            """).format(sql.SQL(", ").join(sql.Literal(bucket) for bucket in buckets)), [ data_type ])
+            res = cur.fetchall()
+
+        if not res:
+            return []
+
+        similarity = sketch.jaccard(signature, [row[1] for row in res])
+
+        # A concept is as similar as its most similar column
+        scores = {}
+        for (uri, _), score in zip(res, similarity):
+            scores[uri] = max(scores.get(uri, 0), score)
+
+        return [uri for uri, score in sorted(scores.items(), key=lambda item: -item[1]) if score >= min_similarity][:limit]
+
+
+    def test_header(self, col1, col2, min_similarity=1.0):
+        return header_similarity(normalize_header(col1), normalize_header(col2)) >= min_similarity
+
+
+    def tablesample(self, table_name, max_rows, seed=0):
+        """
+        TABLESAMPLE clause that reads about twice max_rows rows of a large table
+
+        Tables that were never analyzed have no row estimate, their number
+        of rows is guessed from their size instead.
+        """
+
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("""
+                select case when reltuples > 0 then reltuples else pg_relation_size(oid) / %s end
+                from pg_class
+                where oid = to_regclass(%s)
+            """, [ ROW_SIZE_GUESS, sql.Identifier(table_name).as_string(cur) ])
+            res = cur.fetchone()
+            estimate = res[0] if res else -1
+
+        # Oversample a bit, since some of the rows will be null
+        if estimate > 2 * max_rows:
+            return sql.SQL("tablesample system ({}) repeatable ({})").format(
+                sql.Literal(100.0 * 2 * max_rows / estimate),
+                sql.Literal(seed))
+
+        return sql.SQL("")
+
+
+    @contextmanager
+    def sample_cursor(self):
+        """
+        Server side cursor that only reads the rows that are fetched
+
+        Named cursors need a transaction, which is opened on the connection
+        of the thread and rolled back once the sample is taken.
+        """
+
+        with self.connect() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor(name=f"sample_{uuid.uuid4().hex}") as cur:
+                    cur.itersize = 1000
+                    yield cur
+            finally:
+                conn.rollback()
+                conn.autocommit = True
+
+
+    def sample_table(self, table_name, columns, max_rows=SAMPLE_ROWS, max_time=SAMPLE_TIME, seed=0):
+        """
+        Sample several columns with a single scan of the table
+
+        Works like `sample_column`, but samples whole rows. Returns the non
+        null values of each column in the sampled rows.
+        """
+
+        tablesample = self.tablesample(table_name, max_rows, seed)
+
+        rng = random.Random(seed)
+        sample = []
+        started = time.time()
+
+        with self.sample_cursor() as cur:
+            cur.execute(sql.SQL("select {} from {} {}").format(
+                sql.SQL(", ").join([sql.Identifier(column_name) for column_name in columns]),
+                sql.Identifier(table_name),
+                tablesample
+            ))
 
-        return best_candidates
+            for i, row in enumerate(cur, 1):
+                if i <= max_rows:
+                    sample.append(row)
+                else:
+                    j = rng.randrange(i)
+                    if j < max_rows:
+                        sample[j] = row
 
+                if i % 1000 == 0 and time.time() - started > max_time:
+                    break
 
-    def test_header(self, col1, col2):
-        simplify = lambda x: x \
-            .replace(" ", "") \
-            .replace("_", "") \
-            .replace("-", "") \
-            .lower()
+        return {column_name: [row[k] for row in sample if row[k] is not None] for k, column_name in enumerate(columns)}
 
-        return simplify(col1) == simplify(col2)
 
+    def sample_column(self, table_name, column_name, data_type, max_rows=SAMPLE_ROWS, max_time=SAMPLE_TIME, seed=0):
+        """
+        Sample the non null values of a column within a row and time budget
 
-    def suggest_concept(self, table_name, column_name, compare_headers=False, autogenerate=True):
+        Large tables are sampled with TABLESAMPLE SYSTEM, so only a fraction
+        of their pages is read. Rows are streamed through a server side
+        cursor into a reservoir of at most max_rows values. The sample is
+        yielded every time the number of rows read doubles and once at the
+        end, so the caller can stop early.
+        """
+
+        tablesample = self.tablesample(table_name, max_rows, seed)
+
+        rng = random.Random(seed)
+        sample = []
+        checkpoint = min(1000, max_rows)
+        started = time.time()
+
+        with self.sample_cursor() as cur:
+            cur.execute(sql.SQL(f"select {{}}::{data_type} from {{}} {{}} where {{}} is not null").format(
+                sql.Identifier(column_name),
+                sql.Identifier(table_name),
+                tablesample,
+                sql.Identifier(column_name)
+            ))
+
+            i = 0
+            for i, (value,) in enumerate(cur, 1):
+                if i <= max_rows:
+                    sample.append(value)
+                else:
+                    j = rng.randrange(i)
+                    if j < max_rows:
+                        sample[j] = value
+
+                if i == checkpoint:
+                    yield sample
+                    checkpoint *= 2
+
+                if i % 1000 == 0 and time.time() - started > max_time:
+                    break
+
+        if i != checkpoint // 2:
+            yield sample
+
+
+    def filter_headers(self, column_name, candidates, min_similarity=1.0):
+        """
+        Keep the candidates that were used for a column with a similar name
+
+        The normalized column names of all candidates are fetched from the
+        concepts__headers index at once. With a min_similarity below 1 the
+        names are matched fuzzily (see `header_similarity`).
+        """
+
+        if len(candidates) == 0:
+            return []
+
+        normalized = normalize_header(column_name)
+
+        with self.connect() as conn, conn.cursor() as cur:
+            if min_similarity >= 1.0:
+                cur.execute("select distinct uri from concepts__headers where uri = any(%s) and normalized = %s", [ candidates, normalized ])
+                matches = set(row[0] for row in cur.fetchall())
+            else:
+                cur.execute("select uri, normalized from concepts__headers where uri = any(%s)", [ candidates ])
+                matches = set(uri for uri, other in cur.fetchall() if header_similarity(normalized, other) >= min_similarity)
+
+        return [candidate for candidate in candidates if candidate in matches]
+
+
+    def suggest_concept(self, table_name, column_name, compare_headers=False, min_header_similarity=1.0, autogenerate=True, max_rows=SAMPLE_ROWS, max_time=SAMPLE_TIME, early_stop=True, text_scorer="bayes"):
         """
         Find a suitable concept for the given column
 
@@ -247,13 +1111,21 @@ class Annotate:
         of candidates. These candidates will consist of generated concepts and do not imply
         semantic similarity, but will help with annotating the right data attributes.
         3. If no candidates were found, a new concept is generated instead.
+
+        The data is sampled within the given budget (see `sample_column`). With
+        early_stop, sampling ends as soon as the top candidates are the same
+        for three growing samples in a row. Text columns are scored as
+        described in `test_rules`.
         """
 
-        with self.conn.cursor() as cur:
+        self.load_rules()
+
+        with self.connect() as conn, conn.cursor() as cur:
             cur.execute("""
-                select coalesce(b.uri, a.uri)
-                from concepts__data a
+                select coalesce(b.uri, a.uri), a.uri, c.column_name is not null
+                from concepts__sketches a
                 left join concepts b on (a.uri = b.narrower)
+                left join changed_columns c on (a.table_name = c.table_name and a.column_name = c.column_name)
                 where a.table_name = %s
                 and a.column_name = %s
                 limit 1
@@ -262,41 +1134,31 @@ class Annotate:
 
             # This table / column combo already has a concept
             if res is not None and res[0] is not None:
+                # The column was re-ingested with different values, update the concept data
+                if res[2]:
+                    cur.execute("select data_type::text from information_schema.columns where table_name = %s and column_name = %s", [ table_name, column_name ])
+                    data_type, = cur.fetchone()
+                    self.refresh_concept_data(res[1], data_type, table_name, column_name)
+
                 return res[0]
 
 
-        with self.conn.cursor() as cur:
+        with self.connect() as conn, conn.cursor() as cur:
             cur.execute("select data_type::text from information_schema.columns where table_name = %s and column_name = %s", [ table_name, column_name ])
             data_type, = cur.fetchone()
 
-            cur.execute(sql.SQL(f"select {{}}::{data_type} from {{}} where {{}} is not null").format(
-                sql.Identifier(column_name),
-                sql.Identifier(table_name),
-                sql.Identifier(column_name)
-            ))
-            data = [row[0] for row in cur.fetchall()]
+        candidates = []
+        previous, stable = None, 0
+        for data in self.sample_column(table_name, column_name, data_type, max_rows=max_rows, max_time=max_time):
+            candidates = self.test_rules(data_type, data, text_scorer)
 
-        # Get a list of potential concepts based on the data
-        if data_type in ("bigint", "integer", "double precision"):
-            candidates = self.test_numeric_rules(data)
-        elif data_type in ("date", "timestamp"):
-            candidates = self.test_date_rules(data)
-        else:
-            candidates = self.test_text_rules(data)
+            stable = stable + 1 if candidates[:3] == previous else 0
+            previous = candidates[:3]
+            if early_stop and stable >= 2:
+                break
 
         if compare_headers:
-            _candidates = []
-
-            # Verify if the columns names are somewhat similar
-            with self.conn.cursor() as cur:
-                for candidate in candidates:
-                    cur.execute("select column_name from concepts__data where uri = %s group by uri, column_name", [ candidate ])
-                    cols = [row[0] for row in cur.fetchall()]
-
-                    if len(list(filter(lambda x: self.test_header(column_name, x), cols))) > 0:
-                        _candidates.append(candidate)
-
-            candidates = _candidates
+            candidates = self.filter_headers(column_name, candidates, min_similarity=min_header_similarity)
 
         concept = candidates[0] if len(candidates) > 0 else None
 
@@ -308,6 +1170,66 @@ class Annotate:
         return concept
 
 
+    def suggest_table(self, table_name, compare_headers=False, min_header_similarity=1.0, autogenerate=True, max_rows=SAMPLE_ROWS, max_time=SAMPLE_TIME, text_scorer="bayes"):
+        """
+        Find a suitable concept for every column of a table at once
+
+        Works like `suggest_concept`, but reads the table once for all
+        columns that do not have a concept yet, and copies the values of all
+        columns in a single transaction. Returns the
+        concept of each column.
+        """
+
+        self.load_rules()
+
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("select column_name, data_type::text from information_schema.columns where table_name = %s and column_name != 'geom' order by ordinal_position", [ table_name ])
+            data_types = dict(cur.fetchall())
+
+            cur.execute("""
+                select a.column_name, coalesce(b.uri, a.uri), a.uri, c.column_name is not null
+                from concepts__sketches a
+                left join concepts b on (a.uri = b.narrower)
+                left join changed_columns c on (a.table_name = c.table_name and a.column_name = c.column_name)
+                where a.table_name = %s
+            """, [ table_name ])
+            existing = {row[0]: row[1:] for row in cur.fetchall()}
+
+        concepts = {}
+        refresh = []
+
+        for column_name, (concept, uri, changed) in existing.items():
+            if column_name not in data_types:
+                continue
+
+            # This table / column combo already has a concept, update its data when it was re-ingested
+            concepts[column_name] = concept
+            if changed:
+                refresh.append((column_name, uri, data_types[column_name]))
+
+        columns = [column_name for column_name in data_types if column_name not in concepts]
+        samples = self.sample_table(table_name, columns, max_rows=max_rows, max_time=max_time) if columns else {}
+
+        for column_name in columns:
+            data_type = data_types[column_name]
+            candidates = self.test_rules(data_type, samples[column_name], text_scorer)
+
+            if compare_headers:
+                candidates = self.filter_headers(column_name, candidates, min_similarity=min_header_similarity)
+
+            concept = candidates[0] if len(candidates) > 0 else None
+
+            if autogenerate and concept is None:
+                concept = self.auto_generate_concept(table_name, column_name, data_type)
+
+            concepts[column_name] = concept
+            refresh.append((column_name, concept, data_type))
+
+        self.refresh_table_data(table_name, refresh)
+
+        return concepts
+
+
 if __name__ == "__main__":
     annotate = Annotate()
 
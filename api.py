@@ -1,51 +1,120 @@
-import psycopg2
+import json
+import threading
 
-from flask import Flask, request, jsonify
+from collections import OrderedDict
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS, cross_origin
 from psycopg2 import sql
 
-from ingest import ingest
+import db
+import httpcache
+import jobs
+import publishers as publisher_store
+
 from annotate import Annotate
 from extract import WebDriver
 
+JOB_WORKERS = 2
+
+# Default number of rows returned by /sample, and the number of samples kept in memory
+SAMPLE_SIZE = 10
+SAMPLE_CACHE_SIZE = 256
+
+# Minimum number of pages read when sampling a large table
+SAMPLE_MIN_PAGES = 10
+
+# Pages of at most this many publishers are built in memory instead of streamed, so they can be cached
+PUBLISHERS_PAGE_SIZE = 1000
+
 app = Flask(__name__)
 cors = CORS(app)
+response_cache = httpcache.ResponseCache()
 
 annotate = Annotate()
 webdriver = WebDriver()
 webdriver.visit("http://localhost:3000")
 
+sample_cache = OrderedDict()
+sample_lock = threading.Lock()
 
-def setup():
-    with psycopg2.connect("host=localhost") as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                create table if not exists metamapper (
-                    uri text,
-                    field text,
-                    xpath text,
-                    value text,
 
-                    primary key (uri, field)
-                );
-            """)
+def table_version(cur, table_name):
+    """
+    Changes whenever a table is reloaded, or its source is ingested again
+    """
+
+    cur.execute("select to_regclass(%s)::oid, to_regclass('sources') is not null", [ sql.Identifier(table_name).as_string(cur) ])
+    oid, has_sources = cur.fetchone()
+
+    digest = None
+    if has_sources:
+        cur.execute("select digest from sources where %s = any(tables)", [ table_name ])
+        res = cur.fetchone()
+        digest = res[0] if res else None
+
+    return oid, digest
 
 
 @app.route('/sample', methods=['GET'])
 def sample():
+    """
+    Random rows of a table, without its geometry columns
+
+    Large tables are sampled by page with TABLESAMPLE SYSTEM, reading at
+    least SAMPLE_MIN_PAGES pages, and rows are picked at random from those.
+    Smaller tables are shuffled as a whole. The same seed gives the same
+    rows. Samples are cached until the table changes.
+    """
+
     source = request.args.get("source")
+    size = request.args.get("size", SAMPLE_SIZE, type=int)
+    seed = request.args.get("seed", 0, type=int)
 
-    data = []
-    with psycopg2.connect("host=localhost") as conn:
+    with db.connect() as conn:
         with conn.cursor() as cur:
-            cur.execute(sql.SQL("select * from {} limit 10").format(sql.Identifier(source)))
-            columns = [d[0] for d in cur.description]
-            realdata = [dict(zip(columns, row)) for row in cur.fetchall()]
+            key = (source, table_version(cur, source), size, seed)
+
+            with sample_lock:
+                if key in sample_cache:
+                    sample_cache.move_to_end(key)
+                    return jsonify(sample_cache[key])
+
+            cur.execute("select column_name from information_schema.columns where table_name = %s and udt_name not in ('geometry', 'geography') order by ordinal_position", [ source ])
+            columns = [row[0] for row in cur.fetchall()]
+
+            # Tables that were never analyzed have no page count yet, use their size instead
+            cur.execute("""
+                select greatest(relpages, pg_relation_size(oid) / current_setting('block_size')::int), reltuples
+                from pg_class
+                where oid = to_regclass(%s)
+            """, [ sql.Identifier(source).as_string(cur) ])
+            pages, estimate = cur.fetchone()
+
+            # Makes random() repeatable within this transaction
+            cur.execute("select setseed(%s)", [ (seed % 2 ** 31) / 2 ** 31 ])
+
+            query = sql.SQL("select {} from {} {} order by random() limit {}")
+            projection = sql.SQL(", ").join(map(sql.Identifier, columns))
+
+            rows = []
+            if pages > SAMPLE_MIN_PAGES:
+                percentage = max(SAMPLE_MIN_PAGES / pages, 2 * size / estimate if estimate > 0 else 0)
+                tablesample = sql.SQL("tablesample system ({}) repeatable ({})").format(sql.Literal(min(100.0, 100.0 * percentage)), sql.Literal(seed))
+
+                cur.execute(query.format(projection, sql.Identifier(source), tablesample, sql.Literal(size)))
+                rows = cur.fetchall()
 
-            for row in realdata: # drop geoms
-                if "geom" in row:
-                    del row["geom"]
-                    data.append(row)
+            # Sampled pages can come up short, shuffle the whole table then
+            if len(rows) < size:
+                cur.execute(query.format(projection, sql.Identifier(source), sql.SQL(""), sql.Literal(size)))
+                rows = cur.fetchall()
+
+    data = [dict(zip(columns, row)) for row in rows]
+
+    with sample_lock:
+        sample_cache[key] = data
+        while len(sample_cache) > SAMPLE_CACHE_SIZE:
+            sample_cache.popitem(last=False)
 
     return jsonify(data)
 
@@ -53,28 +122,48 @@ def sample():
 @app.route('/ingest', methods=['GET'])
 def trigger_ingest():
     url = request.args.get("url")
-    table_name = ingest(url)
+    job_id = jobs.enqueue(url)
 
-    with psycopg2.connect("host=localhost") as conn:
-        with conn.cursor() as cur:
-            cur.execute("select column_name from information_schema.columns where table_name = %s and column_name != 'geom'", [ table_name ])
-            columns = [row[0] for row in cur.fetchall()]
+    return jsonify({"status": "ok", "job": job_id})
 
-    for column_name in columns:
-        annotate.suggest_concept(table_name, column_name)
 
-    return jsonify({"status": "ok"})
+@app.route('/jobs/<int:job_id>', methods=['GET', 'DELETE'])
+def job(job_id):
+    if request.method == 'DELETE':
+        return jsonify({"status": "ok" if jobs.cancel(job_id) else "error"})
+
+    res = jobs.get(job_id)
+    if res is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+
+    return jsonify(res)
+
+
+@app.route('/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    return jsonify({"status": "ok" if jobs.retry(job_id) else "error"})
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({"pool": db.stats()})
+
 
 @app.route('/suggest', methods=['GET'])
 def suggest():
     source = request.args.get("source")
     field = request.args.get("field")
 
+    # Without a field, suggest concepts for the whole table
+    if not field:
+        return jsonify({"concepts": annotate.suggest_table(source)})
+
     suggestion = annotate.suggest_concept(source, field)
     return jsonify({"concept": suggestion})
 
 
 @app.route('/concepts', methods=['GET', 'POST'])
+@response_cache
 def concepts():
     if request.method == 'POST':
         return post_concept(request.json)
@@ -92,7 +181,7 @@ def post_concept(data):
         propertytype = data.get("property")
         dataset = data.get("dataset")
 
-        with psycopg2.connect("host=localhost") as conn:
+        with db.connect() as conn:
             with conn.cursor() as cur:
                 cur.execute("""
                     update concepts set
@@ -113,7 +202,7 @@ def post_concept(data):
 def get_concepts():
     resp = []
 
-    with psycopg2.connect("host=localhost") as conn:
+    with db.connect() as conn:
         with conn.cursor() as cur:
             cur.execute("select uri, name from concepts where narrower is not null")
             res = cur.fetchall()
@@ -129,37 +218,28 @@ def extract():
     url = request.args.get("url")
     results = webdriver.extract(url)
 
-    with psycopg2.connect("host=localhost") as conn:
+    with db.connect() as conn:
         with conn.cursor() as cur:
-            for k, v in results.items():
-                cur.execute("""
-                    insert into metamapper (uri, field, xpath, value) values
-                        (%(uri)s, %(field)s, %(xpath)s, %(value)s)
-                    on conflict on constraint metamapper_pkey do update set
-                        xpath = excluded.xpath,
-                        value = excluded.value;
-                """, {
-                    "uri": url,
-                    "field": k,
-                    "xpath": v[0],
-                    "value": v[1]
-                })
+            publisher_store.upsert(cur, [(url, k, v[0], v[1]) for k, v in results.items()])
 
     return get_publisher(url)
 
 
 @app.route('/publishers', methods=['GET', 'POST', 'DELETE'])
+@response_cache
 def publishers():
     if request.method == 'POST':
         return post_publisher(request.json)
     elif request.method == 'DELETE':
         return delete_publisher(request.args.get("url"))
+    elif request.args.get("url"):
+        return get_publisher(request.args.get("url"), request.args.get("fields"))
     else:
-        return get_publisher(request.args.get("url"))
+        return list_publishers(request.args.get("after"), request.args.get("limit", type=int), request.args.get("fields"))
 
 
 def delete_publisher(url):
-    with psycopg2.connect("host=localhost") as conn:
+    with db.connect() as conn:
         with conn.cursor() as cur:
             cur.execute("""
                 delete from metamapper
@@ -168,23 +248,42 @@ def delete_publisher(url):
 
     return jsonify({"status": "ok"})
 
-def get_publisher(url):
-    resp = []
+def get_publisher(url, fields=None):
+    publisher = publisher_store.get(url, fields.split(",") if fields else None)
 
-    with psycopg2.connect("host=localhost") as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                select uri, array_agg(json_build_object(field, value))
-                from metamapper
-                where %(filter)s or uri = %(uri)s
-                group by uri
-            """, { "filter": url is None, "uri": url })
+    return jsonify([publisher] if publisher else [])
 
-            res = cur.fetchall()
-            for row in res:
-                resp.append({k: v for a in row[1] for k, v in a.items()})
 
-    return jsonify(resp)
+def list_publishers(after=None, limit=None, fields=None):
+    """
+    Stream publishers as a JSON list, or as JSON lines when asked for
+
+    Pass the url of the last publisher as `after` to get the next page.
+    Pages with a `limit` of at most PUBLISHERS_PAGE_SIZE are not streamed,
+    so that the response cache can keep them.
+    """
+
+    rows = publisher_store.iterate(after, limit, fields.split(",") if fields else None)
+
+    if request.args.get("format") == "ndjson" or "application/x-ndjson" in request.headers.get("Accept", ""):
+        def generate():
+            for row in rows:
+                yield json.dumps(row) + "\n"
+
+        mimetype = "application/x-ndjson"
+    else:
+        def generate():
+            yield "["
+            for i, row in enumerate(rows):
+                yield ("," if i else "") + json.dumps(row)
+            yield "]"
+
+        mimetype = "application/json"
+
+    if limit is not None and limit <= PUBLISHERS_PAGE_SIZE:
+        return Response("".join(generate()), mimetype=mimetype)
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
 
 def post_publisher(data):
     url = data.get("access_url")
@@ -192,23 +291,33 @@ def post_publisher(data):
         raise Exception("Access url is required")
 
 
-    with psycopg2.connect("host=localhost") as conn:
+    with db.connect() as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-                insert into metamapper (uri, field, value) values
-                    (%(uri)s, %(field)s, %(value)s)
-                on conflict on constraint metamapper_pkey do update
-                    set value = excluded.value;
-            """, {
-                "uri": url,
-                "field": "access_url",
-                "value": url
-            })
+            publisher_store.upsert(cur, [(url, "access_url", None, url)])
 
     return jsonify({"status": "ok"})
 
 
-setup()
+@app.route('/publishers/bulk', methods=['POST'])
+def post_publishers():
+    """
+    Write a list of publishers, each a map of fields to values, at once
+    """
+
+    try:
+        n = publisher_store.import_publishers(request.json)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    return jsonify({"status": "ok", "publishers": n})
+
+
+publisher_store.setup()
+httpcache.setup()
+jobs.setup()
+for _ in range(JOB_WORKERS):
+    jobs.Worker(annotate).start()
+
 app.run(host="localhost", port=8000, debug=False)
 
 
@@ -0,0 +1,300 @@
+import fcntl
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+
+from contextlib import contextmanager
+from functools import partial
+
+CACHE_DIR = os.environ.get("METAMAPPER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "metamapper"))
+CACHE_SIZE = int(os.environ.get("METAMAPPER_CACHE_SIZE", 10 * 1024 ** 3))
+
+# Pinned files can be evicted after this many seconds, in case they are never released
+PIN_TIMEOUT = 24 * 60 * 60
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on a file, between processes as well as threads
+    """
+
+    with open(path, "a") as fout:
+        fcntl.flock(fout, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fout, fcntl.LOCK_UN)
+
+
+def download(url, path, checksum=None, headers={}, chunk_size=1 << 20, callback=None):
+    """
+    Stream a download to disk in chunks
+
+    The response is written to a ".part" file next to the destination and
+    only moved into place once complete, so an interrupted download can be
+    resumed with an HTTP Range request. The ETag or Last-Modified of the
+    first response is kept next to it and sent as If-Range, so a file that
+    changed in the meantime is downloaded again from the start instead of
+    being joined to the old part. Gzip encoded responses are decoded
+    on the fly. Returns the sha256 hexdigest of the stored file, which must
+    match `checksum` when given, together with the response headers. The
+    optional callback is called with the number of bytes of each chunk.
+    """
+
+    part_file = path + ".part"
+    validator_file = path + ".validator"
+    offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+
+    validator = None
+    if offset and os.path.isfile(validator_file):
+        with open(validator_file, "r") as fin:
+            validator = fin.read().strip() or None
+
+    def restart():
+        for name in (part_file, validator_file):
+            if os.path.isfile(name):
+                os.remove(name)
+        return download(url, path, checksum=checksum, headers=headers, chunk_size=chunk_size, callback=callback)
+
+    # Without a way to tell whether the file changed, the part cannot be trusted
+    if offset and validator is None:
+        return restart()
+
+    req = urllib.request.Request(url, headers=headers)
+    if offset:
+        req.add_header("Range", f"bytes={offset}-")
+        req.add_header("If-Range", validator)
+
+    try:
+        response = urllib.request.urlopen(req)
+    except urllib.error.HTTPError as e:
+        # The part file is already complete (or the server disagrees about it), start over
+        if e.code != 416 or not offset:
+            raise
+        return restart()
+
+    digest = hashlib.sha256()
+    with response:
+        info = response.info()
+        encoding = response.info().get("Content-Encoding")
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding == "gzip" else None
+
+        # The server may answer with a different range than the one asked for
+        if response.status == 206:
+            match = re.match(r"bytes (\d+)-", info.get("Content-Range", ""))
+            if match is None or int(match.group(1)) != offset:
+                response.close()
+                return restart()
+
+        # Decoded offsets do not map onto the encoded ranges, so only resume plain responses
+        if response.status != 206 or decoder:
+            offset = 0
+
+            # Remember which version of the file the part belongs to, weak ETags cannot be used with If-Range
+            etag = info.get("ETag")
+            validator = etag if etag and not etag.startswith("W/") else info.get("Last-Modified")
+            if validator and not decoder:
+                with open(validator_file, "w") as fout:
+                    fout.write(validator)
+            elif os.path.isfile(validator_file):
+                os.remove(validator_file)
+
+        size = response.info().get("Content-Length")
+        size = int(size) + offset if size is not None and not decoder else None
+
+        with open(part_file, "r+b" if offset else "w+b") as fout:
+            # Include the previously downloaded part in the checksum
+            for chunk in iter(partial(fout.read, chunk_size), b""):
+                digest.update(chunk)
+
+            fout.seek(offset)
+            fout.truncate()
+
+            if callback and offset:
+                callback(offset)
+
+            for chunk in iter(partial(response.read, chunk_size), b""):
+                if decoder:
+                    chunk = decoder.decompress(chunk)
+                digest.update(chunk)
+                fout.write(chunk)
+
+                if callback:
+                    callback(len(chunk))
+
+            if decoder:
+                chunk = decoder.flush()
+                digest.update(chunk)
+                fout.write(chunk)
+
+            written = fout.tell()
+
+    if size is not None and written != size:
+        raise ValueError(f"Incomplete download of \"{url}\": {written} of {size} bytes")
+
+    if checksum is not None and digest.hexdigest() != checksum:
+        os.remove(part_file)
+        if os.path.isfile(validator_file):
+            os.remove(validator_file)
+        raise ValueError(f"Checksum mismatch for \"{url}\"")
+
+    os.replace(part_file, path)
+    if os.path.isfile(validator_file):
+        os.remove(validator_file)
+
+    return digest.hexdigest(), info
+
+
+class Cache:
+    """
+    Content addressed download cache
+
+    Downloads are stored by the sha256 of their contents, so the same file
+    served from different URLs is only stored once. The
+    cache keeps to a byte budget by evicting the least recently used files,
+    and known URLs are revalidated with ETag / If-Modified-Since so that
+    unchanged files are not downloaded again.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+        for dname in ("objects", "partial"):
+            os.makedirs(os.path.join(self.path, dname), exist_ok=True)
+
+        # The index is shared between download threads
+        self.conn = sqlite3.connect(os.path.join(self.path, "index.db"), isolation_level=None, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.setup()
+
+    def setup(self):
+        self.conn.executescript("""
+            create table if not exists urls (
+                url text primary key,
+                digest text,
+                etag text,
+                last_modified text
+            );
+
+            create table if not exists objects (
+                digest text primary key,
+                size integer,
+                accessed real,
+                pins integer not null default 0,
+                pinned_at real
+            );
+        """)
+
+        columns = [row[1] for row in self.conn.execute("pragma table_info(objects)")]
+        if "pins" not in columns:
+            self.conn.executescript("""
+                alter table objects add column pins integer not null default 0;
+                alter table objects add column pinned_at real;
+            """)
+
+    def object_path(self, digest):
+        return os.path.join(self.path, "objects", digest)
+
+    def fetch(self, url, callback=None, pin=False):
+        """
+        Return the digest and local path of the contents behind a URL
+
+        When the URL was seen before, the request is made conditional and a
+        304 response reuses the cached file. With pin, the file is not
+        evicted until it is released with `release`. Fetches of the same URL,
+        also from other processes, wait for each other since they share the
+        partial file.
+        """
+
+        tmp_file = os.path.join(self.path, "partial", hashlib.md5(url.encode("utf-8")).hexdigest())
+
+        with file_lock(tmp_file + ".lock"):
+            return self.fetch_locked(url, tmp_file, callback, pin)
+
+    def fetch_locked(self, url, tmp_file, callback=None, pin=False):
+        with self.lock:
+            res = self.conn.execute("select digest, etag, last_modified from urls where url = ?", [ url ]).fetchone()
+
+        headers = {}
+        if res is not None and os.path.isfile(self.object_path(res[0])):
+            if res[1]:
+                headers["If-None-Match"] = res[1]
+            if res[2]:
+                headers["If-Modified-Since"] = res[2]
+
+        try:
+            digest, info = download(url, tmp_file, headers=headers, callback=callback)
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or not headers:
+                raise
+
+            digest = res[0]
+            with self.lock:
+                self.touch(digest)
+                if pin:
+                    self.pin(digest)
+            return digest, self.object_path(digest)
+
+        path = self.object_path(digest)
+        with self.lock:
+            if os.path.isfile(path):
+                os.remove(tmp_file)
+            else:
+                os.replace(tmp_file, path)
+
+            self.conn.execute("insert or replace into urls values (?, ?, ?, ?)", [ url, digest, info.get("ETag"), info.get("Last-Modified") ])
+            self.conn.execute("insert or ignore into objects (digest, size, accessed) values (?, ?, ?)", [ digest, os.path.getsize(path), time.time() ])
+            self.touch(digest)
+            if pin:
+                self.pin(digest)
+            self.evict(keep=digest)
+
+        return digest, path
+
+    def touch(self, digest):
+        with self.lock:
+            self.conn.execute("update objects set accessed = ? where digest = ?", [ time.time(), digest ])
+
+    def pin(self, digest):
+        with self.lock:
+            self.conn.execute("update objects set pins = pins + 1, pinned_at = ? where digest = ?", [ time.time(), digest ])
+
+    def release(self, digest):
+        with self.lock:
+            self.conn.execute("update objects set pins = max(pins - 1, 0) where digest = ?", [ digest ])
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the cache fits its budget
+
+        Pinned files are skipped, unless they were pinned too long ago.
+        """
+
+        with self.lock:
+            total, = self.conn.execute("select coalesce(sum(size), 0) from objects").fetchone()
+
+            for digest, size in self.conn.execute("""
+                select digest, size
+                from objects
+                where digest is not ?
+                and (pins = 0 or pinned_at < ?)
+                order by accessed
+            """, [ keep, time.time() - PIN_TIMEOUT ]).fetchall():
+                if total <= self.max_size:
+                    break
+
+                if os.path.isfile(self.object_path(digest)):
+                    os.remove(self.object_path(digest))
+
+                self.conn.execute("delete from objects where digest = ?", [ digest ])
+                self.conn.execute("delete from urls where digest = ?", [ digest ])
+                total -= size
@@ -0,0 +1,281 @@
+import os
+import psycopg2
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from psycopg2 import extensions, sql
+
+# Connection settings, statement timeouts are in milliseconds (0 means no timeout)
+DSN = os.environ.get("METAMAPPER_DSN", "host=localhost")
+POOL_MIN = int(os.environ.get("METAMAPPER_POOL_MIN", 1))
+POOL_MAX = int(os.environ.get("METAMAPPER_POOL_MAX", 20))
+POOL_TIMEOUT = float(os.environ.get("METAMAPPER_POOL_TIMEOUT", 30))
+STATEMENT_TIMEOUT = int(os.environ.get("METAMAPPER_STATEMENT_TIMEOUT", 0))
+
+# Connections that were idle for longer than this many seconds are checked before use
+HEALTH_CHECK_INTERVAL = 30
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class Pool:
+    """
+    Thread-safe pool of database connections
+
+    Keeps between `minconn` and `maxconn` connections open, callers wait
+    for a free connection for at most `timeout` seconds. Connections that
+    were idle for a while are checked before they are handed out, and
+    broken ones are replaced. Every connection gets `statement_timeout` by
+    default, which can be changed for a single checkout.
+    """
+
+    def __init__(self, dsn=DSN, minconn=POOL_MIN, maxconn=POOL_MAX, timeout=POOL_TIMEOUT, statement_timeout=STATEMENT_TIMEOUT):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.statement_timeout = statement_timeout
+
+        self.cond = threading.Condition()
+        self.connections = set()
+        self.inherited = []
+        self.reset()
+
+    def reset(self):
+        # Connections cannot be shared with forked processes, those start with a
+        # pool of their own. The inherited connections are kept referenced and never
+        # closed, since closing them would end the sessions of the parent process.
+        self.inherited.extend(self.connections)
+        self.connections = set()
+
+        self.pid = os.getpid()
+        self.idle = deque()
+        self.size = 0
+        self.custom_timeouts = set()
+        self.counters = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "timeouts": 0,
+            "discarded": 0
+        }
+
+    def connect(self):
+        conn = psycopg2.connect(self.dsn, options=f"-c statement_timeout={self.statement_timeout}")
+
+        with self.cond:
+            self.connections.add(conn)
+
+        return conn
+
+    def healthy(self, conn, idle_since):
+        if conn.closed or conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+
+        if time.time() - idle_since < HEALTH_CHECK_INTERVAL:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def discard(self, conn):
+        with self.cond:
+            self.connections.discard(conn)
+            self.size -= 1
+            self.counters["discarded"] += 1
+            self.cond.notify()
+
+        if not conn.closed:
+            conn.close()
+
+    def getconn(self, statement_timeout=None):
+        started = time.time()
+
+        with self.cond:
+            if os.getpid() != self.pid:
+                self.reset()
+
+            # Open the minimum number of connections on first use
+            while self.size < self.minconn:
+                self.idle.append((self.connect(), time.time()))
+                self.size += 1
+
+            waited = False
+            while True:
+                if self.idle:
+                    conn, idle_since = self.idle.pop()
+                    break
+
+                if self.size < self.maxconn:
+                    self.size += 1
+                    conn, idle_since = None, None
+                    break
+
+                remaining = self.timeout - (time.time() - started)
+                if remaining <= 0:
+                    self.counters["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout} seconds")
+
+                waited = True
+                self.cond.wait(remaining)
+
+            self.counters["checkouts"] += 1
+            if waited:
+                self.counters["waits"] += 1
+            self.counters["wait_time"] += time.time() - started
+
+        if conn is not None and not self.healthy(conn, idle_since):
+            self.discard(conn)
+            with self.cond:
+                self.size += 1
+            conn = None
+
+        if conn is None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self.cond:
+                    self.size -= 1
+                    self.cond.notify()
+                raise
+
+        if statement_timeout is not None and statement_timeout != self.statement_timeout:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("set statement_timeout = %s", [ statement_timeout ])
+            conn.autocommit = False
+
+            with self.cond:
+                self.custom_timeouts.add(id(conn))
+
+        return conn
+
+    def putconn(self, conn):
+        if os.getpid() != self.pid:
+            return
+
+        with self.cond:
+            custom_timeout = id(conn) in self.custom_timeouts
+            self.custom_timeouts.discard(id(conn))
+
+        try:
+            if not conn.closed and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+            if not conn.closed and custom_timeout:
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("reset statement_timeout")
+
+            if not conn.closed:
+                conn.autocommit = False
+        except psycopg2.Error:
+            pass
+
+        if conn.closed or conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            return self.discard(conn)
+
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self, statement_timeout=None):
+        """
+        Check out a connection for the duration of a with block
+
+        Like a psycopg2 connection used as a context manager, the transaction
+        is committed at the end of the block, or rolled back on an exception.
+        """
+
+        conn = self.getconn(statement_timeout)
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self):
+        with self.cond:
+            return {
+                **self.counters,
+                "size": self.size,
+                "idle": len(self.idle),
+                "in_use": self.size - len(self.idle),
+                "min": self.minconn,
+                "max": self.maxconn
+            }
+
+
+pool = Pool()
+
+
+def connect(statement_timeout=None):
+    return pool.connection(statement_timeout)
+
+
+def stats():
+    return pool.stats()
+
+
+def setup_version(cur, name, tables):
+    """
+    Keep a version number that changes with every write to the given tables
+
+    The number is kept in the table "<name>__version". Triggers bump it once
+    per statement, so writes from other processes are noticed as well.
+    """
+
+    cur.execute(sql.SQL("""
+        create table if not exists {version} (
+            version bigint not null
+        );
+        insert into {version} select 0 where not exists (select 1 from {version});
+
+        create or replace function {bump}() returns trigger as $$
+        begin
+            update {version} set version = version + 1;
+            return null;
+        end;
+        $$ language plpgsql;
+    """).format(version=sql.Identifier(f"{name}__version"), bump=sql.Identifier(f"{name}__bump_version")))
+
+    for table in tables:
+        cur.execute(sql.SQL("""
+            drop trigger if exists {trigger} on {table};
+            create trigger {trigger}
+                after insert or update or delete or truncate on {table}
+                for each statement execute procedure {bump}();
+        """).format(
+            trigger=sql.Identifier(f"{table}__{name}_version"),
+            table=sql.Identifier(table),
+            bump=sql.Identifier(f"{name}__bump_version")))
+
+
+def copy_value(value):
+    """
+    Format a value for the text format of COPY
+    """
+
+    if value is None:
+        return "\\N"
+
+    if isinstance(value, (list, tuple)):
+        value = "{" + ",".join('"%s"' % str(v).replace('\\', '\\\\').replace('"', '\\"') for v in value) + "}"
+    elif isinstance(value, (bytes, bytearray)):
+        value = "\\x" + value.hex()
+
+    return str(value) \
+        .replace("\\", "\\\\") \
+        .replace("\t", "\\t") \
+        .replace("\n", "\\n") \
+        .replace("\r", "\\r")
@@ -0,0 +1,103 @@
+import functools
+import hashlib
+import threading
+
+from collections import OrderedDict
+from flask import Response, make_response, request
+
+import db
+
+# Number of responses kept in memory
+CACHE_SIZE = 1024
+
+
+def setup():
+    """
+    Keep a version number that changes with every write to concepts or metamapper
+
+    Triggers bump it, so writes from other processes (such as the ingest
+    and publisher command line tools) are noticed as well.
+    """
+
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            db.setup_version(cur, "api", ["concepts", "metamapper"])
+
+
+def version():
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("select version from api__version")
+            return cur.fetchone()[0]
+
+
+class LRUBackend:
+    """
+    In-process store of the most recently used responses
+
+    Other backends only need the same `get` and `set` methods.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class ResponseCache:
+    """
+    Caches GET responses of Flask views until the data changes
+
+    Responses are keyed on the request and the current version, so a write
+    makes every older response unreachable. The key also serves as ETag,
+    a matching If-None-Match gets a 304 without running the view at all.
+    Streamed responses get an ETag but are not stored.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or LRUBackend()
+
+    def __call__(self, view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+
+            # The version is read first, a write while the view runs can only make the response newer
+            key = "\n".join([str(version()), request.full_path, request.headers.get("Accept", "")])
+            etag = hashlib.md5(key.encode("utf-8")).hexdigest()
+
+            if etag in request.if_none_match:
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            cached = self.backend.get(key)
+            if cached is not None:
+                body, mimetype = cached
+                response = Response(body, mimetype=mimetype)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.backend.set(key, (response.get_data(), response.mimetype))
+
+            response.set_etag(etag)
+            return response
+
+        return wrapper
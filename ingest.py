@@ -1,132 +1,531 @@
+import argparse
 import csv
-import io
+import datetime
 import gzip
+import io
 import hashlib
+import json
 import magic
+import math
+import mmap
+import multiprocessing
 import os
 import osgeo
-import psycopg2
-import tempfile
+import random
+import re
+import time
 import tqdm
-import urllib.request
 import zipfile
 
-from ast import literal_eval
-from contextlib import suppress
-from dateutil import parser
+import db
+
+from cache import Cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from osgeo import ogr
 from psycopg2 import sql
 
+cache = Cache()
+
 
-def uncompress(file_path, dname):
+# Extensions of archive members that are read as CSV when libmagic only reports text
+TEXT_EXTENSIONS = (".csv", ".tsv", ".txt", "")
+
+
+def member_type(t, name):
     """
-    Uncompress archive and return path to main content
+    Supported type of a (compressed) file, given its libmagic description
     """
 
-    supported_types = [ "Shapefile", "CSV" ]
+    ext = os.path.splitext(name)[1].lower()
 
-    if not os.path.isdir(dname):
-        with zipfile.ZipFile(file_path, 'r') as zout:
-            zout.extractall(dname)
+    if "Shapefile" in t:
+        return "Shapefile"
 
-    filepaths = {}
-    for root, dirs, files in os.walk(dname):
-        for f in files:
-            path = os.path.join(dname, root, f)
-            filepaths[path] = magic.from_file(path)
+    if "CSV" in t or ("text" in t and ext in TEXT_EXTENSIONS):
+        return "CSV"
 
-    for f, t in filepaths.items():
-        for supported_type in supported_types:
-            if supported_type in t:
-                return f, supported_type
+    return None
 
 
-def import_ogr(path, source):
-    datasource = osgeo.ogr.Open(path)
-    layer = datasource.GetLayer(0)
+def uncompress(file_path):
+    """
+    Find the main content of an archive without extracting it
+
+    Members are picked using the central directory of a zip file and the
+    first bytes of each member only. The returned path points into the
+    archive through GDAL's /vsizip/ or /vsigzip/ file systems, which can
+    be read in place by OGR or through `open_text`.
+    """
+
+    if not zipfile.is_zipfile(file_path):
+        with gzip.open(file_path, 'rb') as fin:
+            t = magic.from_buffer(fin.read(2048))
+
+        name = file_path[:-3] if file_path.endswith(".gz") else file_path
+        supported_type = member_type(t, os.path.basename(name))
+        if supported_type is None:
+            raise ValueError(f"Unsupported compressed file type: \"{t}\"")
+
+        return f"/vsigzip/{file_path}", supported_type
+
+    with zipfile.ZipFile(file_path, 'r') as zin:
+        members = [m for m in zin.infolist() if not m.is_dir()]
+
+        # Look at the likely candidates first, so we can usually stop after a single member
+        extensions = (".shp", ".csv")
+        members.sort(key=lambda m: os.path.splitext(m.filename)[1].lower() not in extensions)
+
+        for member in members:
+            with zin.open(member) as fin:
+                t = magic.from_buffer(fin.read(2048))
+
+            supported_type = member_type(t, member.filename)
+            if supported_type is not None:
+                return f"/vsizip/{file_path}/{member.filename}", supported_type
+
+    raise ValueError(f"No supported file found in archive \"{file_path}\"")
+
+
+@contextmanager
+def open_text(path):
+    """
+    Open a file for reading text, which may be inside an archive
+    """
+
+    if path.startswith("/vsigzip/"):
+        with gzip.open(path[len("/vsigzip/"):], 'rt') as fin:
+            yield fin
+        return
+
+    if path.startswith("/vsizip/"):
+        parts = path[len("/vsizip/"):].split("/")
+        for i in range(1, len(parts)):
+            archive = "/".join(parts[:i])
+            if os.path.isfile(archive):
+                with zipfile.ZipFile(archive) as zin, io.TextIOWrapper(zin.open("/".join(parts[i:]))) as fin:
+                    yield fin
+                return
+
+    with open(path, 'r') as fin:
+        yield fin
+
+
+def copy_batch(cur, source, buf):
+    """
+    Flush a buffer of COPY formatted rows into the given table
+    """
+
+    if buf.tell() == 0:
+        return
+
+    buf.seek(0)
+    cur.copy_expert(sql.SQL("COPY {} FROM STDIN").format(sql.Identifier(source)), buf)
+    buf.seek(0)
+    buf.truncate()
+
+
+OGR_TYPE_MAPPING = {
+    0: "int",
+    1: "int[]",
+    2: "float8",
+    3: "float8[]",
+    4: "text",
+    5: "text[]",
+    6: "text",
+    7: "text[]",
+    8: "bytea",
+    9: "date",
+    10: "time",
+    11: "timestamp",
+    12: "bigint",
+    13: "bigint[]"
+}
+
+
+def import_layer(cur, layer, table, batch_size=10000, callback=None):
+    """
+    Stream a single OGR layer into its own table
+
+    Features are read sequentially with GetNextFeature, which is cheap for
+    every driver, unlike random access through GetFeature. Only a single
+    batch of rows is kept in memory at any time. The optional callback is
+    called with the number of rows of each batch that was written.
+    """
+
     layer_defn = layer.GetLayerDefn()
+
+    header = [layer_defn.GetFieldDefn(i).GetName() for i in range(0, layer_defn.GetFieldCount())]
+    datatypes = [OGR_TYPE_MAPPING.get(layer_defn.GetFieldDefn(i).GetType(), "text") for i in range(0, layer_defn.GetFieldCount())]
+
+    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+    cur.execute(sql.SQL("CREATE TABLE {} (" + ''.join(["{} %s, " % dtype for dtype in datatypes]) + "geom geometry)").format(
+        sql.Identifier(table),
+        *[sql.Identifier(_) for _ in header]))
+
+    # Do not force a full scan just to count, some drivers cannot do it cheaply
+    nr_rows = layer.GetFeatureCount(0)
+    print(f"Inserting {nr_rows if nr_rows >= 0 else 'unknown number of'} rows into \"{table}\"")
+
+    buf = io.StringIO()
+    progress = tqdm.tqdm(total=nr_rows if nr_rows >= 0 else None, unit="rows")
+    started = time.time()
+
+    layer.ResetReading()
     feature = layer.GetNextFeature()
+    while feature:
+        fields = [feature.GetField(j) for j in range(0, feature.GetFieldCount())]
+
+        # Geometries are sent as hex encoded WKB, which PostGIS reads without parsing WKT
+        geom = feature.GetGeometryRef()
+        fields.append(bytes(geom.ExportToWkb()).hex() if geom else None)
+
+        buf.write('\t'.join(map(db.copy_value, fields)) + '\n')
+        progress.update(1)
+
+        if progress.n % batch_size == 0:
+            copy_batch(cur, table, buf)
+            if callback:
+                callback(batch_size)
+            progress.set_postfix(rows_per_s=int(progress.n / (time.time() - started)))
 
-    type_mapping = {
-        0: "int",
-        1: "int[]",
-        2: "float8",
-        3: "float8[]",
-        4: "text",
-        5: "text[]",
-        6: "text",
-        7: "text[]",
-        8: "bytea",
-        9: "date",
-        10: "time",
-        11: "timestamp",
-        12: "bigint",
-        13: "bigint[]"
-    }
-
-    header = [layer_defn.GetFieldDefn(i).GetName() for i in range(0, feature.GetFieldCount())]
-    datatypes = [type_mapping.get(layer_defn.GetFieldDefn(i).GetType(), "text") for i in range(0, feature.GetFieldCount())]
-
-    with psycopg2.connect("host=localhost") as conn:
+        feature = layer.GetNextFeature()
+
+    copy_batch(cur, table, buf)
+    if callback:
+        callback(progress.n % batch_size)
+    progress.set_postfix(rows_per_s=int(progress.n / max(time.time() - started, 1E-6)))
+    progress.close()
+
+
+def import_ogr(path, source, batch_size=10000, callback=None):
+    """
+    Import every layer of an OGR datasource
+
+    The first layer is written to a table named after the source, any
+    additional layers (e.g. in a GeoPackage or GML file) get a table
+    suffixed with their layer index. Returns the list of created tables.
+    """
+
+    datasource = osgeo.ogr.Open(path)
+
+    tables = []
+    with db.connect(statement_timeout=0) as conn:
         with conn.cursor() as cur:
-            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(source)))
-            cur.execute(sql.SQL("CREATE TABLE {} (" + ','.join(["{} %s" % dtype for dtype in datatypes]) + ", geom geometry)").format(
-                sql.Identifier(source),
-                *[sql.Identifier(_) for _ in header]))
+            for i in range(0, datasource.GetLayerCount()):
+                table = source if i == 0 else f"{source}_{i}"
+                import_layer(cur, datasource.GetLayer(i), table, batch_size=batch_size, callback=callback)
+                tables.append(table)
 
-            nr_rows = layer.GetFeatureCount()
-            print(f"Inserting {nr_rows} rows into \"{source}\"")
+    return tables
 
-            for i in tqdm.tqdm(range(0, nr_rows)):
-                feature = layer.GetFeature(i)
-                if not feature:
-                    continue
 
-                fields = {}
-                for j in range(0, feature.GetFieldCount()):
-                    name = layer_defn.GetFieldDefn(j).GetName()
-                    value = feature.GetField(j)
+# Checked in order, the first pattern that matches a value determines its type
+TYPE_PATTERNS = [
+    ("int", re.compile(r"[+-]?(0|[1-9][0-9]*)")),
+    ("float8", re.compile(r"[+-]?((0|[1-9][0-9]*)(\.[0-9]*)?|\.[0-9]+)([eE][+-]?[0-9]+)?")),
+    ("date", re.compile(r"(?P<year>[0-9]{4})(?P<sep>[-/])(?P<month>[0-9]{1,2})(?P=sep)(?P<day>[0-9]{1,2})")),
+    ("timestamp", re.compile(r"(?P<year>[0-9]{4})(?P<sep>[-/])(?P<month>[0-9]{1,2})(?P=sep)(?P<day>[0-9]{1,2})[T ](?P<hour>[0-9]{1,2}):(?P<minute>[0-9]{2})(:(?P<second>[0-9]{2})(\.[0-9]+)?)?(Z|[+-][0-9]{2}(:?[0-9]{2})?)?")),
+]
 
-                    fields[name] = value
+# Types that can be widened into each other, from narrow to wide
+TYPE_WIDENING = [
+    ("int", "bigint", "float8"),
+    ("date", "timestamp"),
+]
 
-                geom = feature.GetGeometryRef().ExportToWkt()
 
-                # Not very fast, but easier than bulk inserts
-                cur.execute(sql.SQL("INSERT INTO {} VALUES (" + ','.join(("%s",) * (len(header)+1)) + ")").format(
-                    sql.Identifier(source)
-                ), list(fields.values()) + [geom])
+def detect_value_type(value):
+    """
+    Type of a single value, only types that COPY can load the value into
+    """
+
+    for data_type, pattern in TYPE_PATTERNS:
+        match = pattern.fullmatch(value)
+        if not match:
+            continue
+
+        if data_type == "int" and not -2 ** 31 <= int(value) < 2 ** 31:
+            if -2 ** 63 <= int(value) < 2 ** 63:
+                return "bigint"
+            data_type = "float8"
+
+        # Values that overflow, or underflow to zero, are out of range for float8
+        if data_type == "float8":
+            number = float(value)
+            if math.isinf(number) or (number == 0 and re.search(r"[1-9]", value.split("e")[0].split("E")[0])):
+                return "text"
+
+        # Dates that do not exist, such as 2020-13-45
+        if data_type in ("date", "timestamp"):
+            fields = match.groupdict()
+            try:
+                datetime.datetime(*[int(fields[k] or 0) for k in ("year", "month", "day", "hour", "minute", "second") if k in fields])
+            except ValueError:
+                return "text"
+
+        return data_type
+
+    return "text"
+
+
+def widen_type(a, b):
+    if a is None or a == b:
+        return b
+
+    for order in TYPE_WIDENING:
+        if a in order and b in order:
+            return order[max(order.index(a), order.index(b))]
+
+    return "text"
 
 
 def detect_column_type(data):
-    types = set()
+    """
+    Find the narrowest type that fits all values
+
+    Every distinct value is classified once with the patterns above, empty
+    values are skipped since COPY loads them as NULL. Values of only
+    whitespace are not NULL to COPY, and can only be loaded as text.
+    """
+
+    data_type = None
+
+    for value in set(data):
+        if value == "":
+            continue
+
+        data_type = widen_type(data_type, detect_value_type(value.strip()) if value.strip() else "text")
+        if data_type == "text":
+            break
+
+    return data_type or "text"
+
+
+def sample_rows(reader, sample_size, seed=0):
+    """
+    Reservoir sample rows from the entire reader in a single pass
+    """
+
+    rng = random.Random(seed)
+    sample = []
+
+    for i, row in enumerate(reader):
+        if i < sample_size:
+            sample.append(row)
+        else:
+            j = rng.randint(0, i)
+            if j < sample_size:
+                sample[j] = row
+
+    return sample
+
+
+class LineCounter:
+    """
+    Wraps a file to report the number of lines read through a callback
+    """
+
+    def __init__(self, fhandle, callback):
+        self.fhandle = fhandle
+        self.callback = callback
+
+    def read(self, size=-1):
+        data = self.fhandle.read(size)
+        self.callback(data.count('\n' if isinstance(data, str) else b'\n'))
+        return data
+
+    def readline(self, size=-1):
+        data = self.fhandle.readline(size)
+        self.callback(data.count('\n' if isinstance(data, str) else b'\n'))
+        return data
+
+
+class RangeReader:
+    """
+    Reads a byte range of a file as if it were a file by itself
+    """
+
+    def __init__(self, path, start, end):
+        self.fhandle = open(path, 'rb')
+        self.fhandle.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.fhandle.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.fhandle.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.fhandle.close()
+
+
+def quote_parity(m, start, end, quotechar=b'"', block_size=1 << 20):
+    """
+    Return whether a memory map has an odd number of quotes between two offsets
+    """
+
+    parity = 0
+
+    # Count in blocks to avoid copying huge slices out of the map
+    for i in range(start, end, block_size):
+        parity ^= m[i:min(i + block_size, end)].count(quotechar) & 1
+
+    return parity
+
+
+def find_record_end(m, pos, parity=0, quotechar=b'"'):
+    """
+    Return the offset right after the first record boundary at or after pos
+
+    A newline is only a record boundary when it is preceded by an even
+    number of quotes (counted from the start of the file), otherwise it is
+    part of a quoted value. `parity` is the quote parity up to pos.
+    """
+
+    while True:
+        nl = m.find(b'\n', pos)
+        if nl < 0:
+            return len(m)
 
-    for value in data:
-        with suppress(ValueError, SyntaxError):
-            types.add(type(literal_eval(value.strip())).__name__)
+        parity ^= quote_parity(m, pos, nl, quotechar)
+        pos = nl + 1
 
-    if len(types) == 1:
-        return types.pop()
+        if parity == 0:
+            return pos
 
-    # If it's not numeric, it may still be a date
-    with suppress(parser._parser.ParserError):
-        precision = 0
-        for value in data:
-            pvalue = parser.parse(value)
-            precision += pvalue.hour + pvalue.minute + pvalue.second
 
-        return 'timestamp' if precision else 'date'
+def split_csv(path, chunks, quotechar='"'):
+    """
+    Split a CSV file into newline aligned byte ranges without the header
+
+    The quotes are counted up to every split point, so that no range starts
+    in the middle of a quoted value spanning multiple lines.
+    """
+
+    quotechar = quotechar.encode("utf-8")
+
+    with open(path, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        size = len(m)
+        start = find_record_end(m, 0, quotechar=quotechar)
+
+        boundaries = [start]
+        pos = start
+        for k in range(1, chunks):
+            target = start + (size - start) * k // chunks
+            if target <= pos:
+                continue
+
+            parity = quote_parity(m, pos, target, quotechar)
+            pos = find_record_end(m, target, parity, quotechar)
+
+            if boundaries[-1] < pos < size:
+                boundaries.append(pos)
+
+        boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def copy_csv(table, header, datatypes, dialect, skip_header=False):
+    """
+    COPY statement for a CSV file with the given columns
+
+    Quoted empty values are loaded as NULL too in columns that are not text,
+    as the csv module that detected their types cannot tell them apart.
+    """
+
+    options = [
+        sql.SQL("FORMAT csv"),
+        sql.SQL("DELIMITER {}").format(sql.Literal(dialect.delimiter)),
+        sql.SQL("QUOTE {}").format(sql.Literal(dialect.quotechar))
+    ]
+
+    if skip_header:
+        options.append(sql.SQL("HEADER"))
+
+    force_null = [sql.Identifier(column) for column, dtype in zip(header, datatypes) if dtype != "text"]
+    if force_null:
+        options.append(sql.SQL("FORCE_NULL ({})").format(sql.SQL(", ").join(force_null)))
+
+    return sql.SQL("COPY {} FROM STDIN WITH ({})").format(sql.Identifier(table), sql.SQL(", ").join(options))
+
+
+def copy_chunk(table, header, datatypes, dialect, path, start, end, callback=None):
+    """
+    Load a single byte range of a CSV file over its own connection
+    """
 
-    return 'text'
+    reader = RangeReader(path, start, end)
+    started = time.time()
+
+    try:
+        with db.connect(statement_timeout=0) as conn:
+            with conn.cursor() as cur:
+                cur.copy_expert(copy_csv(table, header, datatypes, dialect), LineCounter(reader, callback) if callback else reader)
+                rows = cur.rowcount
+    finally:
+        reader.close()
 
+    elapsed = max(time.time() - started, 1E-6)
+    print(f"Loaded bytes {start}-{end} into \"{table}\": {rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s, {(end - start) / elapsed / 1E6:.1f} MB/s)")
+
+
+def import_csv_parallel(path, source, header, datatypes, dialect, workers=4, callback=None):
+    """
+    Load a large CSV file in parallel chunks
 
-def import_csv(path, source):
+    The file is split into byte ranges that are copied concurrently into an
+    unlogged staging table, each over its own connection. The staging table
+    replaces the target table in a single transaction once all chunks are
+    loaded, so the old contents remain available during the load.
+    """
+
+    staging = f"{source}__staging"
+
+    with db.connect(statement_timeout=0) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+            cur.execute(sql.SQL("CREATE UNLOGGED TABLE {} (" + ','.join(["{} %s" % dtype for dtype in datatypes]) + ")").format(
+                sql.Identifier(staging),
+                *[sql.Identifier(_) for _ in header]))
+
+    chunks = split_csv(path, workers * 4, dialect.quotechar)
+    print(f"Loading \"{source}\" in {len(chunks)} chunks")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(copy_chunk, staging, header, datatypes, dialect, path, start, end, callback) for start, end in chunks]
+        for future in futures:
+            future.result()
+
+    with db.connect(statement_timeout=0) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(sql.Identifier(staging)))
+
+    with db.connect(statement_timeout=0) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(source)))
+            cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(staging), sql.Identifier(source)))
+
+
+def import_csv(path, source, callback=None, sample_size=10000, workers=4, large_file_size=256 * 1024 ** 2):
     header = []
     datatypes = []
 
-    sample_size = 10
-    with open(path, 'r') as fhandle:
+    with open_text(path) as fhandle:
         # Find a sensible offset
-        offset = sum([len(line) for line in fhandle.readlines(sample_size)])
+        offset = sum([len(line) for line in fhandle.readlines(10)])
         fhandle.seek(0)
 
         # Sniff out the file format
@@ -139,13 +538,18 @@ def import_csv(path, source):
 
         reader = csv.reader(fhandle, dialect=dialect)
 
-        # Grab a sample to detect the datatypes
-        data = [row for i, row in enumerate(reader) if i <= sample_size]
-        for i in range(0, len(data[0])):
-            datatypes.append(detect_column_type([row[i] for row in data]))
+        # Grab a sample from the whole file to detect the datatypes
+        data = sample_rows(reader, sample_size)
+        for i in range(0, len(header)):
+            datatypes.append(detect_column_type([row[i] for row in data if i < len(row)]))
+
+        # Large files are loaded in parallel, which needs random access to the file itself
+        if workers > 1 and not path.startswith("/vsi") and os.path.getsize(path) >= large_file_size:
+            import_csv_parallel(path, source, header, datatypes, dialect, workers=workers, callback=callback)
+            return [source]
 
         fhandle.seek(0)
-        with psycopg2.connect("host=localhost") as conn:
+        with db.connect(statement_timeout=0) as conn:
             with conn.cursor() as cur:
                 cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(source)))
                 cur.execute(sql.SQL("CREATE TABLE {} (" + ','.join(["{} %s" % dtype for dtype in datatypes]) + ")").format(
@@ -153,33 +557,230 @@ def import_csv(path, source):
                     *[sql.Identifier(_) for _ in header]))
 
                 # Stream the contents through stdin
-                cur.copy_expert(sql.SQL("COPY {} FROM STDIN CSV HEADER DELIMITER {} QUOTE {}").format(
-                    sql.Identifier(source),
-                    sql.Literal(dialect.delimiter),
-                    sql.Literal(dialect.quotechar)
-                ), fhandle)
+                cur.copy_expert(copy_csv(source, header, datatypes, dialect, skip_header=True), LineCounter(fhandle, callback) if callback else fhandle)
+
+    return [source]
+
+
+def setup(cur):
+    cur.execute("""
+        create table if not exists sources (
+            source text primary key,
+            url text,
+            digest text,
+            tables text[]
+        );
+
+        create table if not exists changed_columns (
+            table_name text,
+            column_name text,
+
+            primary key (table_name, column_name)
+        );
+    """)
+
+
+def mark_changed(cur, table, columns=None):
+    """
+    Record that columns of a table changed, all of them when not given
+
+    Consumers such as `Annotate.refresh_concept_data` clear the record once
+    they processed the new values. Only columns that were annotated before,
+    and so have a sketch, are ever cleared, so the others are not marked.
+    """
+
+    cur.execute("select to_regclass('concepts__sketches') is not null")
+    if not cur.fetchone()[0]:
+        return
 
+    # Marks of columns without a sketch were left by older versions
+    cur.execute("""
+        delete from changed_columns a
+        where a.table_name = %s
+        and not exists (select 1 from concepts__sketches b where a.table_name = b.table_name and a.column_name = b.column_name)
+    """, [ table ])
+
+    cur.execute("""
+        insert into changed_columns
+        select table_name, column_name
+        from concepts__sketches
+        where table_name = %s
+        and (%s::text[] is null or column_name = any(%s::text[]))
+        on conflict do nothing
+    """, [ table, columns, columns ])
+
+
+def table_columns(cur, table):
+    cur.execute("select column_name, data_type::text from information_schema.columns where table_name = %s order by ordinal_position", [ table ])
+    return cur.fetchall()
+
+
+def merge_table(cur, shadow, table):
+    """
+    Apply the contents of a freshly loaded shadow table to an existing table
+
+    Rows are compared by a hash of their contents. Since rows have no key,
+    an updated row shows up as a deleted and an inserted row. Only those
+    rows are written, and only the columns whose values changed (based on
+    an order independent checksum) are marked as changed. When the schema
+    changed the shadow table simply replaces the table.
+    """
+
+    columns = table_columns(cur, table)
+
+    if columns != table_columns(cur, shadow):
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+        cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(shadow), sql.Identifier(table)))
+        mark_changed(cur, table)
+        return
+
+    # Find the columns that changed by comparing a checksum of their values
+    checksum = sql.SQL("select " + ', '.join(["sum(hashtext({}::text)), count({})"] * len(columns)) + " from {}")
+    identifiers = [sql.Identifier(column) for column, _ in columns for _ in range(2)]
+
+    cur.execute(checksum.format(*identifiers, sql.Identifier(table)))
+    old = cur.fetchone()
+    cur.execute(checksum.format(*identifiers, sql.Identifier(shadow)))
+    new = cur.fetchone()
+
+    changed = [column for i, (column, _) in enumerate(columns) if old[i * 2:i * 2 + 2] != new[i * 2:i * 2 + 2]]
+
+    # Remove rows that occur more often in the table than in the shadow table
+    cur.execute(sql.SQL("""
+        delete from {table} where ctid in (
+            select a.ctid
+            from (
+                select ctid, md5(t::text) as h, row_number() over (partition by md5(t::text)) as n
+                from {table} t
+            ) a
+            left join (
+                select md5(s::text) as h, count(*) as n
+                from {shadow} s
+                group by 1
+            ) b on (a.h = b.h)
+            where a.n > coalesce(b.n, 0)
+        )
+    """).format(table=sql.Identifier(table), shadow=sql.Identifier(shadow)))
+    deleted = cur.rowcount
+
+    # Then add rows that occur more often in the shadow table
+    cur.execute(sql.SQL("""
+        insert into {table}
+        select (a.s).*
+        from (
+            select s, md5(s::text) as h, row_number() over (partition by md5(s::text)) as n
+            from {shadow} s
+        ) a
+        left join (
+            select md5(t::text) as h, count(*) as n
+            from {table} t
+            group by 1
+        ) b on (a.h = b.h)
+        where a.n > coalesce(b.n, 0)
+    """).format(table=sql.Identifier(table), shadow=sql.Identifier(shadow)))
+    inserted = cur.rowcount
+
+    cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(shadow)))
+    mark_changed(cur, table, changed)
+
+    print(f"Merged \"{table}\": {inserted} rows inserted, {deleted} rows deleted, {len(changed)} columns changed")
+
+
+def load_cached(cur, source, digest):
+    """
+    Reuse the tables that were already loaded from the same contents
+
+    Returns None when the contents still need to be imported. When another
+    source was loaded from identical contents, its tables are copied within
+    the database instead of parsing the file again.
+    """
+
+    cur.execute("""
+        select source, tables
+        from sources
+        where digest = %s
+        and (select count(*) from information_schema.tables where table_name = any(tables)) = cardinality(tables)
+        order by source = %s desc
+        limit 1
+    """, [ digest, source ])
+    res = cur.fetchone()
+
+    if res is None:
+        return None
+
+    other, tables = res
+    if other == source:
+        return tables
+
+    clones = [source + table[len(other):] for table in tables]
+    for table, clone in zip(tables, clones):
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(clone)))
+        cur.execute(sql.SQL("CREATE TABLE {} AS TABLE {}").format(sql.Identifier(clone), sql.Identifier(table)))
+        cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(clone)))
+        mark_changed(cur, clone)
+
+    return clones
+
+
+def register_source(source, url, digest, tables):
+    with db.connect(statement_timeout=0) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                insert into sources (source, url, digest, tables) values
+                    (%(source)s, %(url)s, %(digest)s, %(tables)s)
+                on conflict on constraint sources_pkey do update set
+                    digest = excluded.digest,
+                    tables = excluded.tables;
+            """, {
+                "source": source,
+                "url": url,
+                "digest": digest,
+                "tables": tables
+            })
+
+
+def fetch(url, callback=None, pin=False):
+    """
+    Download the contents of a URL, this is the network bound part of `ingest`
+
+    With pin, the download stays in the cache until `cache.release` is
+    called with its digest, so it is still there when it is loaded.
+    """
 
-def ingest(url = "https://cmshare.eea.europa.eu/s/n5L8Lrs9aYD775S/download"):
-    tmpdir = tempfile.gettempdir()
     source = hashlib.md5(url.encode("utf-8")).hexdigest()
-    source_file = os.path.join(tmpdir, source)
-
-    if not os.path.isfile(source_file):
-        with open(os.path.join(tmpdir, source), "wb") as fout:
-            response = urllib.request.urlopen(url)
-            if response.info().get("Content-Encoding") == "gzip":
-                buf = io.BytesIO(response.read())
-                data = gzip.GzipFile(fileobj=buf).read()
-            else:
-                data = response.read()
-            fout.write(data)
+    digest, source_file = cache.fetch(url, callback=callback, pin=pin)
+
+    return url, source, digest, source_file
+
+
+def load(url, source, digest, source_file, callback=None, incremental=True):
+    """
+    Import a downloaded file, this is the database bound part of `ingest`
+
+    In incremental mode a source that was loaded before is imported into a
+    shadow table first, which is then merged into the existing table. The
+    existing table stays available during the import and only the rows
+    that changed are written.
+    """
+
+    with db.connect(statement_timeout=0) as conn:
+        with conn.cursor() as cur:
+            setup(cur)
+            tables = load_cached(cur, source, digest)
+
+            cur.execute("select 1 from information_schema.tables where table_name = %s", [ source ])
+            exists = cur.rowcount == 1
+
+    if tables is not None:
+        register_source(source, url, digest, tables)
+        return tables
+
+    target = f"{source}__shadow" if incremental and exists else source
 
     magic_file_type = magic.from_file(source_file)
 
     if "Zip" in magic_file_type or "zip" in magic_file_type:
-        dname = os.path.join(tmpdir, hashlib.md5(source_file.encode("utf-8")).hexdigest())
-        path, file_type = uncompress(source_file, dname=dname)
+        path, file_type = uncompress(source_file)
 
     elif "CSV" in magic_file_type or "text" in magic_file_type:
         path, file_type = (source_file, "CSV")
@@ -201,13 +802,113 @@ def ingest(url = "https://cmshare.eea.europa.eu/s/n5L8Lrs9aYD775S/download"):
         raise ValueError(f"Unknown file type: \"{magic_file_type}\"")
 
     if file_type == "CSV":
-        import_csv(path, source)
+        loaded = import_csv(path, target, callback=callback)
     else: # handles most types
-        import_ogr(path, source)
+        loaded = import_ogr(path, target, callback=callback)
+
+    tables = [source + table[len(target):] for table in loaded]
+
+    with db.connect(statement_timeout=0) as conn:
+        with conn.cursor() as cur:
+            for shadow, table in zip(loaded, tables):
+                if shadow != table:
+                    merge_table(cur, shadow, table)
+                else:
+                    mark_changed(cur, table)
+
+                # Row estimates are used to sample the table when it is annotated
+                cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+
+    register_source(source, url, digest, tables)
+
+    return tables
+
+
+def ingest(url = "https://cmshare.eea.europa.eu/s/n5L8Lrs9aYD775S/download", incremental=True):
+    return load(*fetch(url), incremental=incremental)
+
+
+def ingest_many(urls, download_workers=16, import_workers=4, callback=None, incremental=True):
+    """
+    Ingest a batch of URLs concurrently
+
+    Downloads run in a thread pool and imports in a separate process pool,
+    so network and database work are limited independently. Import
+    processes are spawned rather than forked, so they do not inherit the
+    database connections of the caller. Each finished
+    download is handed to the import pool straight away. Returns a result
+    per URL, holding either the loaded tables or the error that occurred.
+    The optional callback is called with each URL and result as it finishes.
+    """
+
+    results = {}
+
+    with db.connect(statement_timeout=0) as conn:
+        with conn.cursor() as cur:
+            setup(cur)
+
+    def done(url, result):
+        results[url] = result
+        if callback:
+            callback(url, result)
+
+    with ThreadPoolExecutor(max_workers=download_workers) as downloads, \
+         ProcessPoolExecutor(max_workers=import_workers, mp_context=multiprocessing.get_context("spawn")) as imports:
+
+        # Downloads run ahead of the imports, keep them in the cache until they are loaded
+        futures = {downloads.submit(fetch, url, pin=True): url for url in dict.fromkeys(urls)}
+        imported = {}
+
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                fetched = future.result()
+                imported[imports.submit(load, *fetched, incremental=incremental)] = (url, fetched[2])
+            except Exception as e:
+                done(url, {"status": "error", "stage": "download", "error": str(e)})
+
+        for future in as_completed(imported):
+            url, digest = imported[future]
+            cache.release(digest)
+            try:
+                done(url, {"status": "ok", "tables": future.result()})
+            except Exception as e:
+                done(url, {"status": "error", "stage": "import", "error": str(e)})
 
-    return source
+    return results
 
 
 if __name__ == "__main__":
-    table = ingest(url = "https://maps.amsterdam.nl/open_geodata/geojson.php?KAARTLAAG=STADSLANDBOUW_VLAK&THEMA=stadslandbouw")
+    argparser = argparse.ArgumentParser(description="Download and import datasets into PostgreSQL")
+    argparser.add_argument("urls", nargs="*", help="URLs to ingest")
+    argparser.add_argument("-f", "--file", help="file with one URL per line")
+    argparser.add_argument("-o", "--output", help="write the result of each URL to this file as JSON lines")
+    argparser.add_argument("--download-workers", type=int, default=16)
+    argparser.add_argument("--import-workers", type=int, default=4)
+    argparser.add_argument("--full", action="store_true", help="reload tables instead of merging the changes")
+    args = argparser.parse_args()
+
+    urls = list(args.urls)
+    if args.file:
+        with open(args.file, 'r') as fin:
+            urls.extend(line.strip() for line in fin if line.strip())
+
+    if not urls:
+        urls = ["https://maps.amsterdam.nl/open_geodata/geojson.php?KAARTLAAG=STADSLANDBOUW_VLAK&THEMA=stadslandbouw"]
+
+    fout = open(args.output, 'w') if args.output else None
+
+    def report(url, result):
+        print(url, result["status"], result.get("error", ""))
+        if fout:
+            fout.write(json.dumps({"url": url, **result}) + "\n")
+            fout.flush()
+
+    results = ingest_many(urls, download_workers=args.download_workers, import_workers=args.import_workers, callback=report, incremental=not args.full)
+
+    if fout:
+        fout.close()
+
+    failed = len([r for r in results.values() if r["status"] != "ok"])
+    print(f"Ingested {len(results) - failed} of {len(results)} URLs")
 
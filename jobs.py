@@ -0,0 +1,313 @@
+import os
+import psycopg2
+import threading
+import time
+
+from collections import defaultdict
+from functools import partial
+from psycopg2.extras import RealDictCursor
+
+import db
+import ingest
+
+# Running jobs that did not report for this many seconds are considered abandoned and queued again
+LEASE_TIMEOUT = int(os.environ.get("METAMAPPER_JOB_LEASE_TIMEOUT", 300))
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def setup():
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                create table if not exists jobs (
+                    id serial primary key,
+                    url text not null,
+                    status text not null default 'queued',
+                    attempts int not null default 0,
+                    max_attempts int not null default 3,
+                    bytes_downloaded bigint not null default 0,
+                    rows_loaded bigint not null default 0,
+                    columns_annotated int not null default 0,
+                    columns_total int,
+                    tables text[],
+                    error text,
+                    created_at timestamptz not null default now(),
+                    updated_at timestamptz not null default now()
+                );
+                create index if not exists "jobs_queued_idx" on jobs (id) where status = 'queued';
+            """)
+
+    requeue()
+
+
+def requeue():
+    """
+    Queue running jobs again when their lease expired
+
+    Running jobs send a heartbeat, so only jobs of a worker that stopped
+    (or of a server that went down) are taken over, never the jobs that
+    other servers are still working on.
+    """
+
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                update jobs set status = 'queued', updated_at = now()
+                where status = 'running'
+                and updated_at < now() - make_interval(secs => %s)
+            """, [ LEASE_TIMEOUT ])
+            return cur.rowcount
+
+
+def enqueue(url, max_attempts=3):
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("insert into jobs (url, max_attempts) values (%s, %s) returning id", [ url, max_attempts ])
+            return cur.fetchone()[0]
+
+
+def get(job_id):
+    with db.connect() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("select * from jobs where id = %s", [ job_id ])
+            return cur.fetchone()
+
+
+def cancel(job_id):
+    """
+    Cancel a job, a running job stops at its next progress report
+    """
+
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("update jobs set status = 'cancelled', updated_at = now() where id = %s and status in ('queued', 'running')", [ job_id ])
+            return cur.rowcount == 1
+
+
+def retry(job_id):
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                update jobs set
+                    status = 'queued',
+                    attempts = 0,
+                    error = null,
+                    updated_at = now()
+                where id = %s
+                and status in ('failed', 'cancelled')
+            """, [ job_id ])
+            return cur.rowcount == 1
+
+
+def claim():
+    """
+    Take the oldest queued job, safe to call from several workers at once
+    """
+
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                update jobs set
+                    status = 'running',
+                    attempts = attempts + 1,
+                    bytes_downloaded = 0,
+                    rows_loaded = 0,
+                    columns_annotated = 0,
+                    updated_at = now()
+                where id = (
+                    select id from jobs
+                    where status = 'queued'
+                    order by id
+                    for update skip locked
+                    limit 1
+                )
+                returning id, url
+            """)
+            return cur.fetchone()
+
+
+def finish(job_id, status, error=None, tables=None):
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            # Failed jobs go back into the queue until they run out of attempts
+            cur.execute("""
+                update jobs set
+                    status = case when %(status)s = 'failed' and attempts < max_attempts then 'queued' else %(status)s end,
+                    error = %(error)s,
+                    tables = coalesce(%(tables)s, tables),
+                    updated_at = now()
+                where id = %(id)s
+                and status = 'running'
+            """, {
+                "id": job_id,
+                "status": status,
+                "error": error,
+                "tables": tables
+            })
+
+
+class Progress:
+    """
+    Collects progress counters of a job and writes them at most once per interval
+
+    Each write also checks whether the job was cancelled in the meantime.
+    Counters can be added to from several threads at once, such as the
+    threads that load the chunks of a large file.
+    """
+
+    def __init__(self, job_id, interval=1.0):
+        self.job_id = job_id
+        self.interval = interval
+        self.counters = defaultdict(int)
+        self.last_flush = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def add(self, key, n):
+        with self.lock:
+            self.counters[key] += n
+            due = time.time() - self.last_flush >= self.interval
+
+        # Threads go on with their work while another one writes
+        if due and not self.flush_lock.locked():
+            self.flush()
+
+    def set(self, key, n):
+        with self.lock:
+            self.counters[key] = n
+
+        self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            self.write()
+
+    def write(self):
+        with self.lock:
+            self.last_flush = time.time()
+            counters = dict(self.counters)
+
+        with db.connect() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    update jobs set
+                        bytes_downloaded = %(bytes_downloaded)s,
+                        rows_loaded = %(rows_loaded)s,
+                        columns_annotated = %(columns_annotated)s,
+                        columns_total = %(columns_total)s,
+                        updated_at = now()
+                    where id = %(id)s
+                    returning status
+                """, {
+                    "id": self.job_id,
+                    "bytes_downloaded": counters.get("bytes_downloaded", 0),
+                    "rows_loaded": counters.get("rows_loaded", 0),
+                    "columns_annotated": counters.get("columns_annotated", 0),
+                    "columns_total": counters.get("columns_total")
+                })
+                res = cur.fetchone()
+
+        if res is None or res[0] != 'running':
+            raise JobCancelled()
+
+
+def run_job(job_id, url, annotate):
+    """
+    Download, import and annotate a single URL while reporting progress
+    """
+
+    progress = Progress(job_id)
+
+    fetched = ingest.fetch(url, callback=partial(progress.add, "bytes_downloaded"), pin=True)
+    try:
+        tables = ingest.load(*fetched, callback=partial(progress.add, "rows_loaded"))
+    finally:
+        ingest.cache.release(fetched[2])
+
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("select count(*) from information_schema.columns where table_name = any(%s) and column_name != 'geom'", [ tables ])
+            columns_total, = cur.fetchone()
+
+    progress.set("columns_total", columns_total)
+
+    for table_name in tables:
+        concepts = annotate.suggest_table(table_name)
+        progress.add("columns_annotated", len(concepts))
+
+    progress.flush()
+
+    return tables
+
+
+class Heartbeat(threading.Thread):
+    """
+    Renews the lease of a running job, also while it reports no progress
+    """
+
+    def __init__(self, job_id, interval=LEASE_TIMEOUT / 3):
+        super().__init__(daemon=True)
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with db.connect() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute("update jobs set updated_at = now() where id = %s and status = 'running'", [ self.job_id ])
+            except psycopg2.Error as e:
+                print(f"Could not renew lease of job {self.job_id}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Worker(threading.Thread):
+    """
+    Background thread that keeps taking jobs from the queue
+    """
+
+    def __init__(self, annotate, poll_interval=1.0):
+        super().__init__(daemon=True)
+        self.annotate = annotate
+        self.poll_interval = poll_interval
+        self.last_requeue = time.time()
+
+    def run(self):
+        while True:
+            try:
+                # Jobs abandoned by a server that went down are taken over without waiting for a restart
+                if time.time() - self.last_requeue >= LEASE_TIMEOUT / 3:
+                    self.last_requeue = time.time()
+                    requeue()
+
+                job = claim()
+            except (psycopg2.Error, db.PoolTimeout) as e:
+                print(f"Could not claim job: {e}")
+                job = None
+
+            if job is None:
+                time.sleep(self.poll_interval)
+                continue
+
+            job_id, url = job
+            heartbeat = Heartbeat(job_id)
+            heartbeat.start()
+            try:
+                tables = run_job(job_id, url, self.annotate)
+                finish(job_id, 'done', tables=tables)
+            except JobCancelled:
+                pass
+            except Exception as e:
+                try:
+                    finish(job_id, 'failed', error=str(e))
+                except (psycopg2.Error, db.PoolTimeout) as e:
+                    # The lease of the job runs out, after which it is queued again
+                    print(f"Could not finish job {job_id}: {e}")
+            finally:
+                heartbeat.stop()
@@ -1,10 +1,12 @@
 import hashlib
-import psycopg2
 import uuid
 import urllib.parse
 
 from psycopg2 import sql
 
+import db
+import sketch
+
 GUESS = False
 
 def ccd_mapper(data_type, concept=None, broader=None):
@@ -21,15 +23,18 @@ def ccd_mapper(data_type, concept=None, broader=None):
     if data_type in mapper:
         return mapper.get(data_type)
 
-    with psycopg2.connect("host=localhost") as conn:
+    with db.connect() as conn:
         with conn.cursor() as cur:
 
             if broader:
                 cur.execute("select narrower from concepts where uri = %s", [ broader ])
                 concept = cur.fetchone()[0]
 
-            cur.execute("select count(distinct value), count(*) from concepts__data where uri = %s", [ concept ])
-            unique, total = cur.fetchone()
+            cur.execute("select rows, count, top, registers from concepts__sketches where uri = %s", [ concept ])
+            sketches = [dict(zip(("rows", "count", "top", "registers"), row)) for row in cur.fetchall()]
+
+            unique = sketch.distinct_count(sketches)
+            total = sum(column_sketch["rows"] for column_sketch in sketches)
 
             is_categorical = unique < 20 and unique != total
             is_bool = unique == 2
@@ -176,7 +181,7 @@ def export():
     concepts = {}
 
 
-    with psycopg2.connect("host=localhost") as conn:
+    with db.connect() as conn:
         conn.autocommit = True
 
         with conn.cursor() as cur:
@@ -202,7 +207,7 @@ def export():
                         "data_type": data_type
                     }
 
-                cur.execute("select column_name, uri from concepts__data where table_name = %s group by uri, column_name", [ publisher["source"] ])
+                cur.execute("select column_name, uri from concepts__sketches where table_name = %s", [ publisher["source"] ])
                 for row in cur.fetchall():
                     column_name, uri = row
                     attributes[column_name] = {**attributes[column_name], **{ "concept_uri": uri }}
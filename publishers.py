@@ -0,0 +1,182 @@
+import argparse
+import csv
+import io
+import json
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import db
+
+# Batches with more rows than this are copied into a staging table instead of inserted directly
+COPY_THRESHOLD = 1000
+
+
+def setup():
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                create table if not exists metamapper (
+                    uri text,
+                    field text,
+                    xpath text,
+                    value text,
+
+                    primary key (uri, field)
+                );
+            """)
+
+
+def publisher_fields(publisher):
+    """
+    Rows of metamapper for a publisher given as a map of fields to values
+    """
+
+    url = publisher.get("access_url")
+    if not url:
+        raise ValueError("Access url is required")
+
+    for field, value in publisher.items():
+        if value is None or value == "":
+            continue
+
+        if not isinstance(value, str):
+            value = json.dumps(value)
+
+        yield (url, field, None, value)
+
+
+def upsert(cur, rows):
+    """
+    Insert or update many (uri, field, xpath, value) rows of metamapper at once
+
+    Later rows for the same uri and field win. Small batches are written
+    with a single multi-row insert, large ones are copied into a staging
+    table and merged from there. A row without an xpath keeps the stored
+    one. Returns the number of rows written.
+    """
+
+    rows = list({(row[0], row[1]): row for row in rows}.values())
+    if not rows:
+        return 0
+
+    merge = """
+        on conflict on constraint metamapper_pkey do update set
+            xpath = coalesce(excluded.xpath, metamapper.xpath),
+            value = excluded.value
+    """
+
+    if len(rows) <= COPY_THRESHOLD:
+        execute_values(cur, "insert into metamapper (uri, field, xpath, value) values %s " + merge, rows, page_size=COPY_THRESHOLD)
+        return len(rows)
+
+    cur.execute("create temporary table metamapper__staging (like metamapper excluding constraints) on commit drop")
+
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(db.copy_value(value) for value in row) + "\n")
+    buf.seek(0)
+    cur.copy_expert("copy metamapper__staging (uri, field, xpath, value) from stdin", buf)
+
+    cur.execute("insert into metamapper (uri, field, xpath, value) select uri, field, xpath, value from metamapper__staging " + merge)
+
+    return len(rows)
+
+
+def import_publishers(publishers):
+    """
+    Write many publishers at once, in a single transaction
+    """
+
+    publishers = list(publishers)
+
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            upsert(cur, (row for publisher in publishers for row in publisher_fields(publisher)))
+
+    return len(publishers)
+
+
+def field_filter(fields):
+    if not fields:
+        return sql.SQL("")
+
+    return sql.SQL("and field = any({})").format(sql.Literal(list(fields)))
+
+
+def get(url, fields=None):
+    """
+    Fields of a single publisher, or None when it is unknown
+
+    Only the given fields are returned when `fields` is set.
+    """
+
+    with db.connect() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("select field, value from metamapper where uri = %s {}").format(field_filter(fields)), [ url ])
+            res = cur.fetchall()
+
+    return dict(res) if res else None
+
+
+def iterate(after=None, limit=None, fields=None, itersize=1000):
+    """
+    Generate publishers ordered by their url
+
+    Paginated by keyset: the next page starts after the url of the last
+    publisher of the previous one. Publishers are read in batches with a
+    server side cursor that walks the primary key, so neither the query
+    nor the caller has to hold all of them at once. Every publisher has
+    its `access_url`, also when `fields` leaves it out, which is the key
+    for the next page.
+    """
+
+    query = sql.SQL("""
+        select uri, array_agg(field), array_agg(value)
+        from metamapper
+        where {} {}
+        group by uri
+        order by uri
+        {}
+    """).format(
+        sql.SQL("uri > {}").format(sql.Literal(after)) if after is not None else sql.SQL("true"),
+        field_filter(fields),
+        sql.SQL("limit {}").format(sql.Literal(limit)) if limit is not None else sql.SQL(""))
+
+    with db.connect() as conn:
+        with conn.cursor(name="publishers") as cur:
+            cur.itersize = itersize
+            cur.execute(query)
+
+            for uri, keys, values in cur:
+                yield { **dict(zip(keys, values)), "access_url": uri }
+
+
+def read_publishers(path):
+    """
+    Read publishers from a CSV file with a header, or from JSON lines
+    """
+
+    with open(path, 'r', newline='') as fin:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(fin)
+        else:
+            for line in fin:
+                if line.strip():
+                    yield json.loads(line)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Import publishers and their fields into PostgreSQL")
+    argparser.add_argument("files", nargs="+", help="CSV files with an access_url column, or JSON lines files with one publisher per line")
+    args = argparser.parse_args()
+
+    setup()
+
+    total = 0
+    for path in args.files:
+        n = import_publishers(read_publishers(path))
+        print(f"Imported {n} publishers from {path}")
+        total += n
+
+    print(f"Imported {total} publishers")
@@ -0,0 +1,254 @@
+import hashlib
+import math
+import numpy as np
+
+from psycopg2 import sql
+
+# Number of quantiles kept for numeric columns (0%, 1%, ..., 100%)
+QUANTILES = 101
+
+# Number of most frequent values kept per column
+TOP_K = 20
+
+# Number of HyperLogLog registers, must be a power of two
+HLL_REGISTERS = 1024
+HLL_BITS = int(math.log2(HLL_REGISTERS))
+
+# Number of MinHash bins, must be a power of two no larger than HLL_REGISTERS
+MINHASH_BINS = 128
+MINHASH_BITS = int(math.log2(MINHASH_BINS))
+
+# MinHash bins are split into bands for locality sensitive hashing. With 32
+# bands of 4 bins, columns with a Jaccard similarity of about 0.4 or more
+# are likely to share a bucket
+LSH_BANDS = 32
+
+# Marks a bin without any values
+MINHASH_EMPTY = 2 ** 63 - 1
+
+
+def compute_sketches(cur, relation, columns):
+    """
+    Summarize columns of a relation with mergeable sketches
+
+    `columns` is a list of (column name, is numeric). For every column this
+    collects the number of rows and non null values, HyperLogLog registers
+    and a MinHash signature of its distinct values and its most frequent
+    values. Numeric columns also get their sum, sum of squares and
+    quantiles. All columns are summarized at once with two scans of the
+    relation, one for the counts and moments and one for everything that
+    depends on the distinct values.
+    """
+
+    sketches = {column_name: {
+        "rows": 0,
+        "count": 0,
+        "sum": None,
+        "sum_sq": None,
+        "quantiles": None,
+        "registers": [0] * HLL_REGISTERS,
+        "minhash": [MINHASH_EMPTY] * MINHASH_BINS,
+        "top": {}
+    } for column_name, _ in columns}
+
+    if len(columns) == 0:
+        return sketches
+
+    values = sql.SQL(", ").join([sql.SQL("({}, {}::text)").format(
+        sql.Literal(column_name),
+        sql.Identifier("t", column_name)
+    ) for column_name, _ in columns])
+
+    # Counts and moments
+    aggregates = []
+    for column_name, numeric in columns:
+        identifier = sql.Identifier(column_name)
+        aggregates.append(sql.SQL("count({})").format(identifier))
+
+        if numeric:
+            aggregates.append(sql.SQL("sum({0}::float8), sum({0}::float8 ^ 2), percentile_cont({1}::float8[]) within group (order by {0}::float8)").format(
+                identifier,
+                sql.Literal([i / (QUANTILES - 1) for i in range(QUANTILES)])))
+
+    cur.execute(sql.SQL("select count(*), {} from {} t").format(sql.SQL(", ").join(aggregates), relation))
+    res = list(cur.fetchone())
+
+    rows = res.pop(0)
+    for column_name, numeric in columns:
+        sketch = sketches[column_name]
+        sketch["rows"] = rows
+        sketch["count"] = res.pop(0)
+
+        if numeric:
+            sketch["sum"], sketch["sum_sq"], sketch["quantiles"] = res.pop(0), res.pop(0), res.pop(0)
+
+    # The distinct values are counted once, for the HyperLogLog registers and
+    # MinHash bins as well as the most frequent values. The leftmost set bit
+    # of the remaining hash bits is the HyperLogLog rank, the minimum of the
+    # hashes in a register is merged into its MinHash bin.
+    cur.execute(sql.SQL("""
+        with d as (
+            select v.column_name, v.value, count(*) as n
+            from {relation} t
+            cross join lateral (values {values}) v(column_name, value)
+            where v.value is not null
+            group by 1, 2
+        )
+        select column_name, h & {mask}, max(coalesce(nullif(position('1' in ((h >> {bits})::bit({width}))::text), 0), {width} + 1)), min(h >> {minhash_bits}), null, null
+        from (select column_name, hashtextextended(value, 0) as h from d) _
+        group by 1, 2
+        union all
+        select column_name, null, null, null, value, n
+        from (select column_name, value, n, row_number() over (partition by column_name order by n desc) as rank from d) _
+        where rank <= {k}
+    """).format(
+        mask=sql.Literal(HLL_REGISTERS - 1),
+        bits=sql.Literal(HLL_BITS),
+        width=sql.Literal(64 - HLL_BITS),
+        minhash_bits=sql.Literal(MINHASH_BITS),
+        relation=relation,
+        values=values,
+        k=sql.Literal(TOP_K)))
+
+    for column_name, register, rank, minimum, value, n in cur.fetchall():
+        sketch = sketches[column_name]
+
+        if register is None:
+            sketch["top"][value] = n
+            continue
+
+        sketch["registers"][register] = rank
+        sketch["minhash"][register % MINHASH_BINS] = min(sketch["minhash"][register % MINHASH_BINS], minimum)
+
+    return sketches
+
+
+def distinct_count(sketches):
+    """
+    Estimate the number of distinct values over one or more column sketches
+    """
+
+    if len(sketches) == 0:
+        return 0
+
+    # When the most frequent values cover all values the count is exact
+    top = {}
+    for sketch in sketches:
+        for value, n in sketch["top"].items():
+            top[value] = top.get(value, 0) + n
+
+    if all(sum(sketch["top"].values()) == sketch["count"] for sketch in sketches):
+        return len(top)
+
+    # Otherwise merge the HyperLogLog registers
+    registers = np.max(np.array([sketch["registers"] for sketch in sketches]), axis=0)
+
+    m = HLL_REGISTERS
+    estimate = 0.7213 / (1 + 1.079 / m) * m ** 2 / np.sum(2.0 ** -registers)
+
+    # Use linear counting for small cardinalities
+    zeros = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and zeros > 0:
+        estimate = m * math.log(m / zeros)
+
+    return int(round(estimate))
+
+
+def numeric_summary(sketches):
+    """
+    Merge numeric column sketches into the statistics used for matching
+
+    Returns the number of values, their mean and variance, and the mean and
+    variance of their absolute deviations from the median. The mean and
+    variance are exact, the deviations are approximated from the quantiles.
+    """
+
+    sketches = [sketch for sketch in sketches if sketch["count"] and sketch["quantiles"] and len(sketch["quantiles"]) > 1]
+
+    n = sum(sketch["count"] for sketch in sketches)
+    if n == 0:
+        return 0, np.nan, np.nan, np.nan, np.nan
+
+    mean = sum(sketch["sum"] for sketch in sketches) / n
+    var = (sum(sketch["sum_sq"] for sketch in sketches) - n * mean ** 2) / (n - 1) if n > 1 else np.nan
+
+    # The midpoint between two quantiles stands in for an equal share of the values of its column
+    values = np.concatenate([(np.asarray(sketch["quantiles"][:-1], dtype=float) + np.asarray(sketch["quantiles"][1:], dtype=float)) / 2 for sketch in sketches])
+    weights = np.concatenate([np.full(len(sketch["quantiles"]) - 1, sketch["count"] / (len(sketch["quantiles"]) - 1)) for sketch in sketches])
+
+    order = np.argsort(values)
+    median = values[order][min(np.searchsorted(np.cumsum(weights[order]), n / 2), len(values) - 1)]
+
+    deviations = np.abs(values - median)
+    dev_mean = np.average(deviations, weights=weights)
+    dev_var = np.average((deviations - dev_mean) ** 2, weights=weights) * n / (n - 1) if n > 1 else np.nan
+
+    return n, mean, max(var, 0.0), dev_mean, dev_var
+
+
+def minhash_signature(cur, values):
+    """
+    MinHash signature of a set of values, comparable to those of `compute_sketches`
+
+    The values are hashed by Postgres so that the signatures agree.
+    """
+
+    signature = np.full(MINHASH_BINS, MINHASH_EMPTY, dtype=np.int64)
+
+    cur.execute("""
+        select h & %(mask)s, min(h >> %(bits)s)
+        from (select hashtextextended(v, 0) as h from unnest(%(values)s::text[]) v) _
+        group by 1
+    """, {
+        "mask": MINHASH_BINS - 1,
+        "bits": MINHASH_BITS,
+        "values": list(values)
+    })
+
+    for i, minimum in cur.fetchall():
+        signature[i] = minimum
+
+    return signature
+
+
+def jaccard(a, b):
+    """
+    Estimate the Jaccard similarity of two sets from their MinHash signatures
+
+    `b` can also be a matrix with one signature per row.
+    """
+
+    a, b = np.asarray(a, dtype=np.int64), np.asarray(b, dtype=np.int64)
+    filled = (a != MINHASH_EMPTY) | (b != MINHASH_EMPTY)
+    same = (a == b) & filled
+
+    return np.sum(same, axis=-1) / np.maximum(np.sum(filled, axis=-1), 1)
+
+
+def band_bucket(rows):
+    return int.from_bytes(hashlib.blake2b(rows.tobytes(), digest_size=8).digest(), "little", signed=True)
+
+
+def lsh_buckets(signature):
+    """
+    Hash each band of a MinHash signature into a bucket
+
+    Returns a list of (band, bucket), columns that share a bucket in any
+    band are candidates for being similar. Bands without any values are
+    left out, otherwise all columns with few distinct values would share
+    the buckets of their empty bands.
+    """
+
+    bands = np.array_split(np.asarray(signature, dtype="<i8"), LSH_BANDS)
+
+    return [(band, band_bucket(rows)) for band, rows in enumerate(bands) if np.any(rows != MINHASH_EMPTY)]
+
+
+def empty_buckets():
+    """
+    Buckets of bands without any values, which `lsh_buckets` leaves out
+    """
+
+    bands = np.array_split(np.full(MINHASH_BINS, MINHASH_EMPTY, dtype="<i8"), LSH_BANDS)
+
+    return [(band, band_bucket(rows)) for band, rows in enumerate(bands)]